@@ -6,92 +6,238 @@
 # Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
 # Cubic Bezier upgrade by mitxela, 2021 mitxela.com
 
-from math import cos, sin, asin, atan2, sqrt, pi
-from pcbnew import PCB_VIA, ToMM, PCB_TRACK, PCB_ARC, FromMM, wxPoint, GetBoard, ZONE
+import cProfile
+import os
+import time
+
+from pcbnew import PCB_VIA, ToMM, PCB_TRACK, PCB_ARC, FromMM, GetBoard, ZONE
 from pcbnew import PAD_ATTRIB_PTH, PAD_ATTRIB_SMD, ZONE_FILLER, VECTOR2I
-from pcbnew import STARTPOINT, ENDPOINT, ZONE_SETTINGS, ZONE_CONNECTION_FULL, ZONE_FILL_MODE_POLYGONS
+from pcbnew import ZONE_SETTINGS, ZONE_CONNECTION_FULL, ZONE_FILL_MODE_POLYGONS
+from pcbnew import PCB_GROUP, PCB_SHAPE, SHAPE_T_POLY, Cmts_User
+
+try:
+    from .td_engine import Plan, PROGRESS_STEP
+    from .td_engine import Stats, ShapeCache, BoardData, ZoneTable, BuildOutlines
+    from .td_engine import BuildEndpointIndex, Fingerprint, FingerprintPosition, FollowReach
+    from .td_engine import BuildViaIndex, MatchCandidates, BuildTeardropIndex, HasTeardrop
+    from .td_engine import FitTeardrops, DiscardInSameZone
+    from .td_engine import TRACK, ARC, VIA, PAD_PTH, PAD_SMD
+    from .td_engine import MAGIC_TEARDROP_ZONE_ID
+    from .td_pcbfile import ZoneWriter
+except ImportError:
+    # td.py used on its own, td_engine.py must be next to it
+    from td_engine import Plan, PROGRESS_STEP
+    from td_engine import Stats, ShapeCache, BoardData, ZoneTable, BuildOutlines
+    from td_engine import BuildEndpointIndex, Fingerprint, FingerprintPosition, FollowReach
+    from td_engine import BuildViaIndex, MatchCandidates, BuildTeardropIndex, HasTeardrop
+    from td_engine import FitTeardrops, DiscardInSameZone
+    from td_engine import TRACK, ARC, VIA, PAD_PTH, PAD_SMD
+    from td_engine import MAGIC_TEARDROP_ZONE_ID
+    from td_pcbfile import ZoneWriter
 
 __version__ = "0.6.0"
 
 ToUnits = ToMM
 FromUnits = FromMM
 
-MAGIC_TEARDROP_ZONE_ID = 0x4242
+# Minimum thickness of the teardrop zones, the smallest one allowed
+TEARDROP_MIN_THICKNESS = 25400
+
+# Name of the group holding the outlines drawn by PreviewTeardrops
+PREVIEW_GROUP_NAME = "Teardrops preview"
+
+# HitTest also accepts points close to the outline, 0.2mm in nm
+HIT_MARGIN = 200000
+
+
+def __BoundingRect(item):
+    """Bounding box of the item as a (left, top, right, bottom) tuple"""
+    bbox = item.GetBoundingBox()
+    return (bbox.GetLeft(), bbox.GetTop(), bbox.GetRight(), bbox.GetBottom())
+
+
+def __AddZones(table, zones):
+    """Add the given zones to the zone table"""
+    for zone in zones:
+        table.Append(zone.GetAssignedPriority(), zone.GetNetname(),
+                     zone.GetLayerSet().CuStack(), __BoundingRect(zone), zone,
+                     zone.GetZoneName())
+
+
+def __Overlaps(rect, area):
+    """Return True if the two (left, top, right, bottom) rectangles overlap"""
+    return rect[0] <= area[2] and area[0] <= rect[2] and \
+        rect[1] <= area[3] and area[1] <= rect[3]
+
+
+def __AreaZones(pcb, area=None):
+    """Return the zones of the board overlapping area, all if it is None"""
+    zones = [pcb.GetArea(i) for i in range(pcb.GetAreaCount())]
+    if area is None:
+        return zones
+    return [zone for zone in zones if __Overlaps(__BoundingRect(zone), area)]
+
+
+def SnapshotBoard(pcb, scope=None, progress=None):
+    """Copy the tracks, vias, pads and zones of the board into tables,
+    walking each kind of item only once.
 
+    scope, if given, is called with the via table and returns the
+    (left, top, right, bottom) area of interest, or None for the whole
+    board. Only the tracks and zones overlapping it are then copied.
+    progress, if given, is called as progress(done, total) along the way.
+    """
+    board = BoardData()
 
-def __GetAllVias(board):
-    """Just retreive all via from the given board"""
-    vias = []
-    vias_selected = []
-    for item in board.GetTracks():
+    start = time.time()
+    all_tracks = pcb.GetTracks()
+    pads = pcb.GetPads()
+    # Tracks are walked twice, the zones count as a single step
+    total = 2*len(all_tracks) + len(pads) + 1
+    items = []
+    for i, item in enumerate(all_tracks):
+        if progress is not None and i % PROGRESS_STEP == 0:
+            progress(i, total)
+        if not isinstance(item, PCB_TRACK):
+            continue
+        pos = item.GetStart()
+        end = item.GetEnd()
         if item.GetClass() == "PCB_VIA":
-            pos = item.GetPosition()
-            width = item.GetWidth()
-            drill = PCB_VIA(item).GetDrillValue()
+            kind = VIA
+            board.vias.Append(VIA, (pos.x, pos.y), item.GetWidth(),
+                              PCB_VIA(item).GetDrillValue(), -1,
+                              item.IsSelected(), item)
+        elif type(item) == PCB_ARC:
+            kind = ARC
+        else:
+            kind = TRACK
+        items.append((kind, item, pos, end))
+    board.timings["tracks"] = time.time() - start
+
+    start = time.time()
+    done = len(all_tracks)
+    for i, pad in enumerate(pads):
+        if progress is not None and i % PROGRESS_STEP == 0:
+            progress(done + i, total)
+        attribute = pad.GetAttribute()
+        if attribute == PAD_ATTRIB_PTH:
+            kind = PAD_PTH
             layer = -1
-            vias.append((pos, width, drill, layer))
-            if item.IsSelected():
-                vias_selected.append((pos, width, drill, layer))
-    return vias, vias_selected
-
-
-def __GetAllPads(board, filters=[]):
-    """Just retreive all pads from the given board"""
-    pads = []
-    pads_selected = []
-    for pad in board.GetPads():
-        if pad.GetAttribute() in filters:
-            pos = pad.GetPosition()
-            drill = min(pad.GetSize())
-            # See where the pad is
-            if pad.GetAttribute() == PAD_ATTRIB_SMD:
-                # Cannot use GetLayer here because it returns the non-flipped
-                # layer. Need to get the real layer from the layer set
-                cu_stack = pad.GetLayerSet().CuStack()
-                if len(cu_stack) == 0:
-                    # The pad is not on a Copper layer
-                    continue
-                layer = cu_stack[0]
-            else:
-                layer = -1
-            pads.append((pos, drill, 0, layer))
+        elif attribute == PAD_ATTRIB_SMD:
+            kind = PAD_SMD
+            # Cannot use GetLayer here because it returns the non-flipped
+            # layer. Need to get the real layer from the layer set
+            cu_stack = pad.GetLayerSet().CuStack()
+            if len(cu_stack) == 0:
+                # The pad is not on a Copper layer
+                continue
+            layer = cu_stack[0]
+        else:
+            continue
+        pos = pad.GetPosition()
+        board.vias.Append(kind, (pos.x, pos.y), min(pad.GetSize()), 0, layer,
+                          pad.IsSelected(), pad)
+    board.timings["pads"] = time.time() - start
+
+    start = time.time()
+    area = board.area = scope(board.vias) if scope is not None else None
+    tracks = board.tracks
+    done += len(pads)
+    for i, (kind, item, pos, end) in enumerate(items):
+        if progress is not None and i % PROGRESS_STEP == 0:
+            progress(done + i, total)
+        if area is not None and not __Overlaps(
+                (min(pos.x, end.x), min(pos.y, end.y),
+                 max(pos.x, end.x), max(pos.y, end.y)), area):
+            continue
+        row = tracks.Append(kind, (pos.x, pos.y), (end.x, end.y),
+                            item.GetWidth(), item.GetLayer(),
+                            item.GetNetname(), item.GetLength(), item)
+        if kind == ARC:
+            center = item.GetPosition()  # or maybe item.GetCenter()
+            tracks.SetArc(row, (center.x, center.y), item.GetRadius(),
+                          item.GetAngle().AsTenthsOfADegree(),
+                          item.GetArcAngleStart().AsTenthsOfADegree(),
+                          item.GetArcAngleEnd().AsTenthsOfADegree())
+    board.timings["tracks"] += time.time() - start
+
+    start = time.time()
+    if progress is not None:
+        progress(total - 1, total)
+    __AddZones(board.zones, __AreaZones(pcb, area))
+    board.timings["zones"] = time.time() - start
+    if progress is not None:
+        progress(total, total)
+    return board
+
+
+def __GetTeardrops(pcb, nets=None, layers=None, selected=False, region=None):
+    """Return the teardrop zones passing all the given filters, walking the
+    zones once, and the number of teardrops left out"""
+    positions = None
+    if selected:
+        # Teardrops of the selected vias/pads
+        positions = set()
+        for item in pcb.GetTracks():
+            if item.GetClass() == "PCB_VIA" and item.IsSelected():
+                pos = item.GetPosition()
+                positions.add((pos.x, pos.y))
+        for pad in pcb.GetPads():
             if pad.IsSelected():
-                pads_selected.append((pos, drill, 0, layer))
-    return pads, pads_selected
-
-
-def __GetAllTeardrops(board):
-    """Just retrieves all teardrops of the current board classified by net"""
-    teardrops_zones = {}
-    for zone in [board.GetArea(i) for i in range(board.GetAreaCount())]:
-        if zone.GetAssignedPriority() == MAGIC_TEARDROP_ZONE_ID:
-            netname = zone.GetNetname()
-            if netname not in teardrops_zones.keys():
-                teardrops_zones[netname] = []
-            teardrops_zones[netname].append(zone)
-    return teardrops_zones
-
-
-def __DoesTeardropBelongTo(teardrop, track, via):
-    """Return True if the teardrop covers given track AND via"""
-    # First test if the via belongs to the teardrop
-    if not teardrop.HitTest(via[0]):
-        return False
-    # In a second time, test if the track belongs to the teardrop
-    if not track.HitTest(teardrop.GetBoundingBox().GetCenter()):
-        return False
-    return True
+                pos = pad.GetPosition()
+                positions.add((pos.x, pos.y))
+
+    teardrops = []
+    filtered = 0
+    for i in range(pcb.GetAreaCount()):
+        zone = pcb.GetArea(i)
+        if zone.GetAssignedPriority() != MAGIC_TEARDROP_ZONE_ID:
+            continue
+        if nets is not None and zone.GetNetname() not in nets:
+            filtered += 1
+            continue
+        if layers is not None and zone.GetLayer() not in layers:
+            filtered += 1
+            continue
+        if region is not None or positions is not None:
+            left, top, right, bottom = __BoundingRect(zone)
+        if region is not None and \
+           (right < region[0] or region[2] < left or
+                bottom < region[1] or region[3] < top):
+            filtered += 1
+            continue
+        if positions is not None and not zone.IsSelected():
+            position = FingerprintPosition(zone.GetZoneName())
+            if position is not None:
+                hit = position in positions
+            else:
+                # Older teardrop, its outline goes around the via center
+                hit = any(left <= x <= right and top <= y <= bottom
+                          for x, y in positions)
+            if not hit:
+                filtered += 1
+                continue
+        teardrops.append(zone)
+    return teardrops, filtered
 
 
-def __Zone(board, points, track):
+def __HitTeardrop(teardrop, track, via, center):
+    """pcbnew hit tests of an existing teardrop, see HasTeardrop"""
+    return teardrop.HitTest(VECTOR2I(*via[0])) and \
+        track.item.HitTest(VECTOR2I(*center))
+
+
+def __Zone(board, points, track, name):
     """Add a zone to the board"""
     z = ZONE(board)
+    z.SetZoneName(name)
 
     # Add zone properties
-    z.SetLayer(track.GetLayer())
-    z.SetNetCode(track.GetNetCode())
-    z.SetLocalClearance(track.GetLocalClearance(track.GetClass()))
-    z.SetMinThickness(25400)  # The minimum
+    item = track.item
+    z.SetLayer(track.layer)
+    z.SetNetCode(item.GetNetCode())
+    z.SetLocalClearance(item.GetLocalClearance(item.GetClass()))
+    z.SetMinThickness(TEARDROP_MIN_THICKNESS)
     z.SetPadConnection(ZONE_CONNECTION_FULL)
     z.SetCornerSmoothingType(ZONE_SETTINGS.SMOOTHING_NONE)
     z.SetFillMode(ZONE_FILL_MODE_POLYGONS)
@@ -101,361 +247,585 @@ def __Zone(board, points, track):
     ol.NewOutline()
 
     for p in points:
-        ol.Append(p.x, p.y)
+        ol.Append(int(p[0]), int(p[1]))
 
     return z
 
 
-def __Bezier(p1, p2, p3, p4, n=20.0):
-    n = float(n)
-    pts = []
-    for i in range(int(n)+1):
-        t = i/n
-        a = (1.0 - t)**3
-        b = 3.0 * t * (1.0-t)**2
-        c = 3.0 * t**2 * (1.0-t)
-        d = t**3
-
-        x = int(a * p1[0] + b * p2[0] + c * p3[0] + d * p4[0])
-        y = int(a * p1[1] + b * p2[1] + c * p3[1] + d * p4[1])
-        pts.append(wxPoint(x, y))
-    return pts
-
-
-def __PointDistance(a, b):
-    """Distance between two points"""
-    return sqrt((a[0]-b[0])*(a[0]-b[0]) + (a[1]-b[1])*(a[1]-b[1]))
-
-
-def __ComputeCurved(vpercent, w, vec, via, pts, segs):
-    """Compute the curves part points"""
-
-    # A and B are points on the track
-    # C and E are points on the via
-    # D is midpoint behind the via centre
-
-    radius = via[1]/2
-    minVpercent = float(w*2) / float(via[1])
-    weaken = (vpercent/100.0 - minVpercent) / (1-minVpercent) / radius
-
-    biasBC = 0.5 * __PointDistance(pts[1], pts[2])
-    biasAE = 0.5 * __PointDistance(pts[4], pts[0])
-
-    vecC = wxPoint(pts[2].x - via[0].x, pts[2].y - via[0].y)
-    tangentC = [pts[2][0] - vecC[1]*biasBC*weaken,
-                pts[2][1] + vecC[0]*biasBC*weaken]
-    vecE = wxPoint(pts[4].x - via[0].x, pts[4].y - via[0].y)
-    tangentE = [pts[4][0] + vecE[1]*biasAE*weaken,
-                pts[4][1] - vecE[0]*biasAE*weaken]
-
-    tangentB = [pts[1][0] - vec[0]*biasBC, pts[1][1] - vec[1]*biasBC]
-    tangentA = [pts[0][0] - vec[0]*biasAE, pts[0][1] - vec[1]*biasAE]
-
-    curve1 = __Bezier(pts[1], tangentB, tangentC, pts[2], n=segs)
-    curve2 = __Bezier(pts[4], tangentE, tangentA, pts[0], n=segs)
-
-    return curve1 + [pts[3]] + curve2
-
-
-def __FindTouchingTrack(t1, endpoint, trackLookup):
-    """Find a track connected to the end of another track"""
-    match = 0
-    matches = 0
-    ret = False, False
-    for t2 in trackLookup[t1.GetLayer()][t1.GetNetname()]:
-        # The track object can change, this seems like the only
-        # reliable way to test if tracks are the same
-        if t2.GetStart() == t1.GetStart() and t2.GetEnd() == t1.GetEnd():
-            continue
-        match = t2.IsPointOnEnds(endpoint, 10)
-        if match:
-            # if faced with a Y junction, stop here
-            matches += 1
-            if matches > 1:
-                return False, False
-            ret = match, t2
-    return ret
-
-
-def __NormalizeVector(pt):
-    """Make vector unit length"""
-    norm = sqrt(pt.x * pt.x + pt.y * pt.y)
-    return [t / norm for t in pt]
-
-
-def __FindPositionAndVectorAlongArc(track, pos, trackReversed):
-    """ return the x,y position and direction vector at a point on an arc """
-    radius     = track.GetRadius()
-    length     = track.GetLength()
-    arcCenter  = track.GetPosition() # or maybe track.GetCenter()
-
-    # startAngle, endAngle are the absolute start and end.
-    # angle is the included angle of the arc, negative if anticlockwise
-    if trackReversed:
-        angle      = -track.GetAngle().AsTenthsOfADegree()
-        startAngle = track.GetArcAngleEnd().AsTenthsOfADegree()
-    else:
-        angle      = track.GetAngle().AsTenthsOfADegree()
-        startAngle = track.GetArcAngleStart().AsTenthsOfADegree()
-
-
-    posAngle = startAngle + angle * pos/length
-
-    # angle is returned in units of TenthsOfADegree
-    posAngle *= pi/1800
-    pcos = cos(posAngle)
-    psin = sin(posAngle)
-
-    newX = arcCenter.x + pcos * radius
-    newY = arcCenter.y + psin * radius
-
-    # the vector points from start towards end
-    # posAngle points from centre to pos, so rotate by 90 degrees
-    if angle > 0:
-        vec = [ -psin, pcos ]
+def __ZoneContains(zone, point):
+    """Polygon test of a zone, see InSameNetZone"""
+    return zone.Outline().Contains(VECTOR2I(*point))
+
+
+def __BuildAreaIndex(areas):
+    """Build a grid per layer over the given (layer, rect) areas"""
+    area_index = {}
+    if len(areas) == 0:
+        return area_index
+    # Cell size close to the average area size keeps buckets small
+    cell = max(1, int(sum(max(r[2] - r[0], r[3] - r[1]) for _, r in areas) /
+                      len(areas)))
+    for layer, rect in areas:
+        if layer not in area_index:
+            area_index[layer] = (cell, {}, [])
+        grid, rects = area_index[layer][1:]
+        rects.append(rect)
+        for cx in range(rect[0] // cell, rect[2] // cell + 1):
+            for cy in range(rect[1] // cell, rect[3] // cell + 1):
+                if (cx, cy) not in grid:
+                    grid[(cx, cy)] = []
+                grid[(cx, cy)].append(rect)
+    return area_index
+
+
+def __OverlapsArea(area_index, layer, rect):
+    """Return True if rect overlaps one of the areas of the given layer"""
+    if layer not in area_index:
+        return False
+    cell, grid, rects = area_index[layer]
+    left, top, right, bottom = rect
+    cx0, cx1 = left // cell, right // cell
+    cy0, cy1 = top // cell, bottom // cell
+    if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(rects):
+        # Large zone (like a pour), cheaper to test all the areas
+        candidates = rects
     else:
-        vec = [ psin, -pcos ]
-
-    return (wxPoint(newX, newY), vec)
-
-
-def __ComputePoints(track, via, hpercent, vpercent, segs, follow_tracks,
-                    trackLookup, noBulge):
-    """Compute all teardrop points"""
-    start = track.GetStart()
-    end = track.GetEnd()
-    radius = via[1]/2.0
-    w = track.GetWidth()/2
-    trackReversed = False
-
-    if vpercent > 100:
-        vpercent = 100
+        candidates = (r for cx in range(cx0, cx1 + 1)
+                      for cy in range(cy0, cy1 + 1)
+                      for r in grid.get((cx, cy), ()))
+    for r in candidates:
+        if r[0] <= right and left <= r[2] and r[1] <= bottom and top <= r[3]:
+            return True
+    return False
 
-    # ensure that start is at the via/pad end
-    if __PointDistance(start, via[0]) > radius:
-        start, end = end, start
-        trackReversed = True
 
-    # get normalized track vector
-    # it will be used a base vector pointing in the track direction
-    if type(track) == PCB_ARC:
-        arcP, vecT = __FindPositionAndVectorAlongArc(track, radius/2, trackReversed)
-    else:
-        vecT = __NormalizeVector(end - start)
-
-    # Find point of intersection between track and edge of via
-    # This normalizes teardrop lengths
-    bdelta = FromMM(0.01)
-    backoff = 0
-    while backoff < radius:
-        np = wxPoint(vecT[0]*backoff, vecT[1]*backoff)
-        np.x += start.x
-        np.y += start.y
-        if __PointDistance(np, via[0]) >= radius:
-            break
-        backoff += bdelta
-    start = np
-
-    # vec now points from via to intersect point
-    aux = wxPoint(via[0].x, via[0].y)
-    aux.x = start.x - aux.x
-    aux.y = start.y - aux.y
-    vec = __NormalizeVector(aux)
-
-    # choose a teardrop length
-    targetLength = via[1]*(hpercent/100.0)
-    n = min(targetLength, track.GetLength() - backoff)
-    consumed = 0
-
-    if follow_tracks:
-        # if not long enough, attempt to walk back along the curved track
-        while n+consumed < targetLength:
-            match, t = __FindTouchingTrack(track, end, trackLookup)
-            if (match is False):
+def RebuildAllZones(pcb):
+    """Rebuilt all zones, return the number of zones filled"""
+    zones = pcb.Zones()
+    filler = ZONE_FILLER(pcb)
+    filler.Fill(zones)
+    return len(zones)
+
+
+def RebuildZonesInAreas(pcb, areas, zones=None):
+    """Rebuild only the zones overlapping the given (layer, rect) areas.
+    zones is the up to date ZoneTable of the board, if available.
+    Return the number of zones filled"""
+    if zones is None:
+        zones = ZoneTable()
+        __AddZones(zones, [pcb.GetArea(i) for i in range(pcb.GetAreaCount())])
+    area_index = __BuildAreaIndex(areas)
+    to_fill = []
+    for row in range(len(zones)):
+        rect = zones.Rect(row)
+        for layer in zones.layers[row]:
+            if __OverlapsArea(area_index, layer, rect):
+                to_fill.append(zones.items[row])
                 break
-
-            backoff = 0
-            consumed += n
-            n = min(targetLength-consumed, t.GetLength())
-            track = t
-            end = t.GetEnd()
-            start = t.GetStart()
-            if match != STARTPOINT:
-                start, end = end, start
-                trackReversed = True
-            else:
-                trackReversed = False
-
-        # Track may now not point directly at via
-        aux = wxPoint(end.x, end.y)
-        aux.x = aux.x - start.x
-        aux.y = aux.y - start.y
-        vecT = __NormalizeVector(aux)
-
-    # if shortened, shrink width too
-    if n+consumed < targetLength:
-        minVpercent = 100 * float(w) / float(radius)
-        vpercent = vpercent*n/targetLength + minVpercent*(1-n/targetLength)
-
-    # find point on the track, sharp end of the teardrop
-    if type(track) == PCB_ARC:
-        start, vecT = __FindPositionAndVectorAlongArc(track, n + consumed + backoff, trackReversed)
-        pointB = wxPoint(start.x + vecT[1]*w, start.y - vecT[0]*w)
-        pointA = wxPoint(start.x - vecT[1]*w, start.y + vecT[0]*w)
+    if len(to_fill) > 0:
+        filler = ZONE_FILLER(pcb)
+        filler.Fill(to_fill)
+    return len(to_fill)
+
+
+def __Lap(stats, stage, start):
+    """Record the time spent in a stage when stats are wanted"""
+    if stats is None:
+        return time.time()
+    return stats.Lap(stage, start)
+
+
+def __Run(action, stats, profile, *args):
+    """Run SetTeardrops or RmTeardrops with the instrumentation asked for"""
+    run_stats = Stats() if stats else None
+    if profile is not None:
+        profiler = cProfile.Profile()
+        count = profiler.runcall(action, run_stats, *args)
+        profiler.dump_stats(profile)
     else:
-        pointB = wxPoint(start.x + vecT[0]*n + vecT[1]*w, start.y + vecT[1]*n - vecT[0]*w)
-        pointA = wxPoint(start.x + vecT[0]*n - vecT[1]*w, start.y + vecT[1]*n + vecT[0]*w)
-
-    # In some cases of very short, eccentric tracks the points can end up
-    # inside the teardrop. If this happens just cancel adding it
-    if (__PointDistance(pointA, via[0]) < radius or
-       __PointDistance(pointB, via[0]) < radius):
-        return False
-
-    # via side points
-
-    # angular positions of where the teardrop meets the via
-    dC = asin(vpercent/100.0)
-    dE = -dC
-
-    if noBulge:
-        # find (signed) angle between track and teardrop
-        offAngle = atan2(vecT[1], vecT[0]) - atan2(vec[1], vec[0])
-        if offAngle > pi:
-            offAngle -= 2*pi
-        if offAngle < -pi:
-            offAngle += 2*pi
+        count = action(run_stats, *args)
+    if run_stats is None:
+        return count
+    run_stats.count = count
+    return run_stats
 
-        if offAngle+dC > pi/2:
-            dC = pi/2 - offAngle
 
-        if offAngle+dE < -pi/2:
-            dE = -pi/2 - offAngle
-
-    vecC = [vec[0]*cos(dC)+vec[1]*sin(dC), -vec[0]*sin(dC)+vec[1]*cos(dC)]
-    vecE = [vec[0]*cos(dE)+vec[1]*sin(dE), -vec[0]*sin(dE)+vec[1]*cos(dE)]
-
-    #pointC = via[0] + wxPoint(int(vecC[0] * radius), int(vecC[1] * radius))
-    pointC = wxPoint(via[0].x + int(vecC[0] * radius), via[0].y + int(vecC[1] * radius))
-    #pointE = via[0] + wxPoint(int(vecE[0] * radius), int(vecE[1] * radius))
-    pointE = wxPoint(via[0].x + int(vecE[0] * radius), via[0].y + int(vecE[1] * radius))
-
-    # Introduce a last point in order to cover the via centre.
-    # If not, the zone won't be filled
-    pointD = wxPoint(via[0].x + int(vec[0]*-0.5*radius), via[0].y + int(vec[1]*-0.5*radius))
-    #pointD = via[0] + wxPoint(int(vec[0]*-0.5*radius), int(vec[1]*-0.5*radius))
-
-    pts = [pointA, pointB, pointC, pointD, pointE]
-    if segs > 2:
-        pts = __ComputeCurved(vpercent, w, vecT, via, pts, segs)
-
-    return pts
-
-
-def __IsViaAndTrackInSameNetZone(pcb, via, track):
-    """Return True if the given via + track is located inside a zone of the
-    same netname"""
-    for zone in [pcb.GetArea(i) for i in range(pcb.GetAreaCount())]:
-        # Exclude other Teardrops to speed up the process
-        if zone.GetAssignedPriority() == MAGIC_TEARDROP_ZONE_ID:
-            continue
-
-        # Only consider zones on the same layer
-        if not zone.IsOnLayer(track.GetLayer()):
-            continue
+def SetTeardrops(hpercent=50, vpercent=90, segs=10, pcb=None, use_smd=False,
+                 discard_in_same_zone=True, follow_tracks=True, noBulge=True,
+                 incremental_fill=False, workers=1, stats=False, profile=None,
+                 update=False, shape_cache=None, tolerance=0, region=None):
+    """Set teardrops on a teardrop free board
+
+    The options are described in the README. workers is the number of
+    processes computing the shapes (None for one per CPU), keep it to 1
+    inside pcbnew. With stats, a Stats object is returned instead of the
+    teardrop count, and with a profile file name a cProfile dump of the
+    run is written there.
+    """
 
-        if (zone.GetNetname() == track.GetNetname()):
-            if zone.Outline().Contains(VECTOR2I(*via[0])):
-                return True
-    return False
+    if pcb is None:
+        pcb = GetBoard()
 
+    shape_cache, path = __OpenShapeCache(shape_cache, pcb)
+    count = __Run(__SetTeardrops, stats, profile, hpercent, vpercent, segs,
+                  pcb, use_smd, discard_in_same_zone, follow_tracks, noBulge,
+                  incremental_fill, workers, update, shape_cache, tolerance,
+                  region, None)
+    if path is not None:
+        shape_cache.Save(path)
+    return count
 
-def RebuildAllZones(pcb):
-    """Rebuilt all zones"""
-    filler = ZONE_FILLER(pcb)
-    filler.Fill(pcb.Zones())
 
+def PlanTeardrops(hpercent=50, vpercent=90, segs=10, pcb=None, use_smd=False,
+                  discard_in_same_zone=True, follow_tracks=True, noBulge=True,
+                  workers=1, stats=False, update=False, shape_cache=None,
+                  tolerance=0, region=None, progress=None):
+    """First half of SetTeardrops: compute the teardrops, board untouched
 
-def SetTeardrops(hpercent=50, vpercent=90, segs=10, pcb=None, use_smd=False,
-                 discard_in_same_zone=True, follow_tracks=True, noBulge=True):
-    """Set teardrops on a teardrop free board"""
+    The options are the ones of SetTeardrops, the shape cache file being
+    saved once the plan is computed. progress, if given, is called as
+    progress(stage, done, total) along the gather, match, fingerprint and
+    geometry stages; an exception raised there stops the run and leaves
+    the board as it was. This only reads the board, so it may run in a
+    worker thread while ApplyTeardrops, which changes the board, runs in
+    the main one.
+    """
 
     if pcb is None:
         pcb = GetBoard()
+    shape_cache, path = __OpenShapeCache(shape_cache, pcb)
+    plan = __PlanTeardrops(Stats() if stats else None, hpercent, vpercent,
+                           segs, pcb, use_smd, discard_in_same_zone,
+                           follow_tracks, noBulge, workers, update,
+                           shape_cache, tolerance, region, progress)
+    if path is not None:
+        shape_cache.Save(path)
+    return plan
+
+
+def ApplyTeardrops(plan, incremental_fill=False):
+    """Second half of SetTeardrops: remove the stale teardrops of a plan
+    from PlanTeardrops, add the new ones and fill. Return what
+    SetTeardrops would"""
+    count = __ApplyPlan(plan, incremental_fill)
+    if plan.stats is None:
+        return count
+    plan.stats.count = count
+    return plan.stats
+
+
+def PreviewTeardrops(hpercent=50, vpercent=90, segs=10, pcb=None,
+                     use_smd=False, discard_in_same_zone=True,
+                     follow_tracks=True, noBulge=True, workers=1, profile=None,
+                     update=False, shape_cache=None, tolerance=0, region=None,
+                     draw=False):
+    """Compute the teardrops SetTeardrops would add, without changing the
+    board: no zone is added, removed or filled.
+
+    The options are the ones of SetTeardrops. Return a Stats object with
+    the discard reasons in its counters and the (layer, net, points) of
+    each teardrop in its outlines. With draw, the outlines are also drawn
+    as graphic polygons on the Cmts.User layer, in a group ClearPreview
+    removes. Any previous preview is cleared first.
+    """
 
-    pad_types = [PAD_ATTRIB_PTH] + [PAD_ATTRIB_SMD]*use_smd
-    vias = __GetAllVias(pcb)[0] + __GetAllPads(pcb, pad_types)[0]
-    vias_selected = __GetAllVias(pcb)[1] + __GetAllPads(pcb, pad_types)[1]
-    if len(vias_selected) > 0:
-        vias = vias_selected
-
-    trackLookup = {}
-    if follow_tracks:
-        for t in pcb.GetTracks():
-            if isinstance(t, PCB_TRACK):
-                net = t.GetNetname()
-                layer = t.GetLayer()
-
-                if layer not in trackLookup:
-                    trackLookup[layer] = {}
-                if net not in trackLookup[layer]:
-                    trackLookup[layer][net] = []
-                trackLookup[layer][net].append(t)
-
-    teardrops = __GetAllTeardrops(pcb)
+    if pcb is None:
+        pcb = GetBoard()
+    ClearPreview(pcb)
+    shape_cache, path = __OpenShapeCache(shape_cache, pcb)
+    outlines = []
+
+    def Collect(track, outline, name):
+        outlines.append((track.layer, track.net, outline))
+
+    stats = __Run(__SetTeardrops, True, profile, hpercent, vpercent, segs,
+                  pcb, use_smd, discard_in_same_zone, follow_tracks, noBulge,
+                  False, workers, update, shape_cache, tolerance, region,
+                  Collect, False)
+    if path is not None:
+        shape_cache.Save(path)
+    stats.outlines = outlines
+    if draw:
+        group = PCB_GROUP(pcb)
+        group.SetName(PREVIEW_GROUP_NAME)
+        pcb.Add(group)
+        for layer, net, points in stats.outlines:
+            shape = PCB_SHAPE(pcb)
+            shape.SetShape(SHAPE_T_POLY)
+            shape.SetLayer(Cmts_User)
+            shape.SetFilled(False)
+            shape.SetWidth(FromMM(0.02))
+            polygon = shape.GetPolyShape()
+            polygon.NewOutline()
+            for p in points:
+                polygon.Append(int(p[0]), int(p[1]))
+            pcb.Add(shape)
+            group.AddItem(shape)
+    return stats
+
+
+def ClearPreview(pcb=None):
+    """Remove the outlines drawn by PreviewTeardrops, return their number"""
+    if pcb is None:
+        pcb = GetBoard()
     count = 0
+    for group in [g for g in pcb.Groups()
+                  if g.GetName() == PREVIEW_GROUP_NAME]:
+        for item in list(group.GetItems()):
+            pcb.Remove(item)
+            count += 1
+        pcb.Remove(group)
+    return count
 
-    for track in [t for t in pcb.GetTracks() if isinstance(t, PCB_TRACK)]:
-        for via in [v for v in vias if track.IsPointOnEnds(v[0], int(v[1]/2))]:
-            if track.GetWidth() >= via[1] * vpercent / 100:
-                continue
-
-            if track.IsPointOnEnds(via[0], int(via[1]/2)) == \
-               STARTPOINT | ENDPOINT:
-                # both start and end are within the via
-                continue
-
-            found = False
-            if track.GetNetname() in teardrops.keys():
-                for teardrop in teardrops[track.GetNetname()]:
-                    if __DoesTeardropBelongTo(teardrop, track, via):
-                        found = True
-                        break
-
-            # Discard case where pad and track are on different layers, or the
-            # pad have no copper at all (paste pads).
-            if (via[3] != -1) and (via[3] != track.GetLayer()):
-                continue
 
-            # Discard case where pad/via is within a zone with the same netname
-            # WARNING: this can severely reduce performance
-            if discard_in_same_zone and \
-               __IsViaAndTrackInSameNetZone(pcb, via, track):
-                continue
+def WriteTeardrops(path, output=None, hpercent=50, vpercent=90, segs=10,
+                   use_smd=False, discard_in_same_zone=True,
+                   follow_tracks=True, noBulge=True, workers=1, stats=False,
+                   profile=None, shape_cache=None, tolerance=0, region=None,
+                   fill=True):
+    """Add teardrops to a .kicad_pcb file without building pcbnew zones
+
+    The board is loaded to compute the teardrops, then the file is copied
+    to output (path itself by default) and the teardrop zones are streamed
+    into the copy as text. With fill, the copy is loaded once more to fill
+    its zones, else the teardrops are written unfilled. The other options
+    are the ones of SetTeardrops; stale teardrops cannot be removed this
+    way, so there is no update mode.
+    """
+    import pcbnew
+
+    if output is None:
+        output = path
+    pcb = pcbnew.LoadBoard(path)
+    shape_cache, cache_path = __OpenShapeCache(shape_cache, pcb)
+    writer = ZoneWriter(path, output, fill)
+
+    def Write(track, outline, name):
+        item = track.item
+        writer.AddZone(item.GetNetCode(), track.net,
+                       pcb.GetLayerName(track.layer), outline, name,
+                       item.GetLocalClearance(item.GetClass()),
+                       MAGIC_TEARDROP_ZONE_ID, TEARDROP_MIN_THICKNESS)
+
+    try:
+        result = __Run(__SetTeardrops, stats, profile, hpercent, vpercent,
+                       segs, pcb, use_smd, discard_in_same_zone, follow_tracks,
+                       noBulge, False, workers, False, shape_cache, tolerance,
+                       region, Write)
+    except Exception:
+        writer.Abort()
+        raise
+    writer.Close()
+    if cache_path is not None:
+        shape_cache.Save(cache_path)
+
+    if fill:
+        start = time.time()
+        board = pcbnew.LoadBoard(output)
+        filled = RebuildAllZones(board)
+        pcbnew.SaveBoard(output, board)
+        if stats:
+            result.Lap("fill", start)
+            result.Count("zones_filled", filled)
+    return result
+
+
+def ShapeCachePath(pcb):
+    """Return the shape cache file of the board, None if it has no file"""
+    filename = pcb.GetFileName()
+    if not filename:
+        return None
+    return os.path.splitext(filename)[0] + "-teardrops-cache.json"
+
+
+def __OpenShapeCache(shape_cache, pcb):
+    """Turn the shape_cache option into a ShapeCache or None.
+
+    True gives a cache loaded from the board's cache file. Return it with
+    the file to save it to afterwards, None when there is nothing to save.
+    """
+    if shape_cache is not True:
+        return shape_cache or None, None
+    shape_cache = ShapeCache()
+    path = ShapeCachePath(pcb)
+    if path is not None:
+        shape_cache.Load(path)
+    return shape_cache, path
+
+
+def __ProcessedRows(vias, kinds, region):
+    """Rows of the vias/pads to process: the selected ones, or all of them
+    when none is selected, keeping the ones centered in region if given"""
+    rows = vias.Rows(kinds, selected=True, region=region)
+    if len(rows) == 0:
+        rows = vias.Rows(kinds, region=region)
+    return rows
+
+
+def __ScopeArea(vias, rows, hpercent, region):
+    """Area holding every track end and zone the given via rows depend on"""
+    if len(rows) == 0:
+        return region
+    reach = [(vias.x[row], vias.y[row], FollowReach(vias.Via(row), hpercent))
+             for row in rows]
+    return (min(x - r for x, y, r in reach), min(y - r for x, y, r in reach),
+            max(x + r for x, y, r in reach), max(y + r for x, y, r in reach))
+
+
+def __StaleTeardrops(board, rows, kept):
+    """Return the fingerprinted teardrop rows not kept by an update run.
+
+    Teardrops of a via/pad this run did not process are left out.
+    """
+    zones = board.zones
+    processed = set(board.vias.Via(row)[0] for row in rows)
+    skipped = set(board.vias.Via(row)[0] for row in range(len(board.vias)))
+    skipped -= processed
+    stale = []
+    for row in range(len(zones)):
+        if zones.priority[row] != MAGIC_TEARDROP_ZONE_ID or row in kept:
+            continue
+        position = FingerprintPosition(zones.names[row])
+        if position is not None and position not in skipped:
+            stale.append(row)
+    return stale
+
+
+def __SetTeardrops(stats, hpercent, vpercent, segs, pcb, use_smd,
+                   discard_in_same_zone, follow_tracks, noBulge,
+                   incremental_fill, workers, update, shape_cache, tolerance,
+                   region, sink, names=True):
+    """SetTeardrops itself, stats is None when not wanted.
+
+    With a sink, each teardrop is given to sink(track, outline, name)
+    instead of being added as a zone, and the board is left untouched.
+    names is False when the sink has no use for the zone names.
+    """
+    plan = __PlanTeardrops(stats, hpercent, vpercent, segs, pcb, use_smd,
+                           discard_in_same_zone, follow_tracks, noBulge,
+                           workers, update, shape_cache, tolerance, region,
+                           None, names)
+    if sink is None:
+        return __ApplyPlan(plan, incremental_fill)
+
+    start = time.time()
+    for track, outline, name in plan.teardrops:
+        sink(track, outline, name)
+    __Lap(stats, "zones", start)
+    return len(plan.teardrops)
+
+
+def __PlanTeardrops(stats, hpercent, vpercent, segs, pcb, use_smd,
+                    discard_in_same_zone, follow_tracks, noBulge, workers,
+                    update, shape_cache, tolerance, region, progress,
+                    names=True):
+    """Compute the teardrops to add and the stale ones to remove, without
+    touching the board. progress is None or called as for PlanTeardrops.
+    Without names, the teardrops are named None unless update computed
+    their fingerprint anyway"""
+    start = time.time()
+    kinds = [VIA, PAD_PTH] + [PAD_SMD]*use_smd
+
+    def Scope(vias):
+        rows = __ProcessedRows(vias, kinds, region)
+        if region is None and not any(vias.selected[row] for row in rows):
+            return None
+        return __ScopeArea(vias, rows, hpercent, region)
+
+    def GatherProgress(done, total):
+        progress("gather", done, total)
+
+    board = SnapshotBoard(pcb, Scope, GatherProgress if progress else None)
+    tracks = board.tracks
+    rows = __ProcessedRows(board.vias, kinds, region)
+    vias = [board.vias.Via(row) for row in rows]
+    start = __Lap(stats, "gather", start)
+    if stats is not None:
+        stats.Split("gather", board.timings)
+
+    via_index = BuildViaIndex(vias)
+    teardrop_index = BuildTeardropIndex(board.zones, vias, via_index,
+                                        HIT_MARGIN, legacy_only=update)
+
+    def MatchProgress(done, total):
+        progress("match", done, total)
+
+    def Existing(track, via):
+        return HasTeardrop(teardrop_index, track, via, __HitTeardrop)
+
+    candidates = MatchCandidates(tracks, vias, via_index, vpercent, Existing,
+                                 stats, MatchProgress if progress else None)
+    start = __Lap(stats, "match", start)
+
+    params = (hpercent, vpercent, segs, follow_tracks, noBulge)
+    if tolerance:
+        # Keep the fingerprints of the teardrops made without tolerance
+        params += (tolerance,)
+
+    def Fingerprints(candidates):
+        endpoint_index = None
+        if follow_tracks:
+            cell = max([FollowReach(via, hpercent)
+                        for row, via in candidates] + [1])
+            endpoint_index = BuildEndpointIndex(tracks, cell)
+        fingerprints = []
+        for i, (row, via) in enumerate(candidates):
+            if progress is not None and i % PROGRESS_STEP == 0:
+                progress("fingerprint", i, len(candidates))
+            fingerprints.append(Fingerprint(tracks, endpoint_index, row, via,
+                                            params))
+        return fingerprints
+
+    # Without update, only the teardrops added get their fingerprint, and
+    # only when it names their zone
+    fingerprints = [None]*len(candidates)
+    kept = []
+    if update:
+        # Keep the teardrops whose inputs did not change, those still have
+        # to pass the same zone check below
+        fingerprints = Fingerprints(candidates)
+        # The fingerprint leaves the net out, a teardrop whose via and
+        # track moved to another net must not be kept on the old one
+        existing = {}
+        zones = board.zones
+        for row in range(len(zones)):
+            if zones.priority[row] == MAGIC_TEARDROP_ZONE_ID:
+                existing.setdefault((zones.names[row], zones.nets[row]),
+                                    []).append(row)
+        changed = []
+        for candidate, fingerprint in zip(candidates, fingerprints):
+            key = (fingerprint, tracks.nets[tracks.net[candidate[0]]])
+            if existing.get(key):
+                kept.append((candidate, existing[key].pop()))
+            else:
+                changed.append((candidate, fingerprint))
+        candidates = [candidate for candidate, _ in changed]
+        fingerprints = [fingerprint for _, fingerprint in changed]
+    start = __Lap(stats, "fingerprint", start)
+    if stats is not None:
+        stats.Count("hops", 0)
+
+    def GeometryProgress(done, total):
+        progress("geometry", done, total)
+
+    # Discard case where pad/via is within a zone with the same netname
+    contains = __ZoneContains if discard_in_same_zone else None
+    computed = [(candidates[i], fingerprints[i], coor) for i, coor
+                in FitTeardrops(tracks, board.zones, candidates, hpercent,
+                                vpercent, segs, follow_tracks, noBulge,
+                                workers, stats, shape_cache, tolerance,
+                                contains,
+                                GeometryProgress if progress else None)]
+    start = time.time()
+    if discard_in_same_zone:
+        kept = DiscardInSameZone(tracks, board.zones, kept, __ZoneContains,
+                                 stats)
+        start = __Lap(stats, "zone_check", start)
+
+    if names and not update:
+        computed = [(candidate, fingerprint, coor) for (candidate, _, coor),
+                    fingerprint in zip(computed, Fingerprints(
+                        [candidate for candidate, _, _ in computed]))]
+        start = __Lap(stats, "fingerprint", start)
+
+    plan = Plan(pcb, board, stats)
+    if update:
+        plan.stale = __StaleTeardrops(board, rows, set(row for _, row in kept))
+        if stats is not None:
+            stats.Count("kept", len(kept))
+            stats.Count("removed_stale", len(plan.stale))
+
+    outlines = BuildOutlines([coor for _, _, coor in computed], segs,
+                             tolerance)
+    plan.teardrops = [(tracks.Record(row), outline, fingerprint)
+                      for ((row, via), fingerprint, _), outline
+                      in zip(computed, outlines)]
+    __Lap(stats, "geometry", start)
+    if stats is not None:
+        stats.Count("teardrops", len(plan.teardrops))
+        stats.Count("outline_points", sum(len(o) for o in outlines))
+    return plan
+
+
+def __ApplyPlan(plan, incremental_fill):
+    """Remove the stale teardrops of the plan, add its teardrops as zones
+    and fill. Return the number of teardrops added"""
+    start = time.time()
+    pcb, board, stats = plan.pcb, plan.board, plan.stats
+    modified = []
+    for row in plan.stale:
+        modified.append((board.zones.layers[row][0], board.zones.Rect(row)))
+        pcb.Remove(board.zones.items[row])
+    if len(plan.stale) > 0:
+        # The zone table still holds the removed teardrops
+        board.zones = ZoneTable()
+        __AddZones(board.zones, __AreaZones(pcb, board.area))
+
+    for track, outline, name in plan.teardrops:
+        zone = __Zone(pcb, outline, track, name)
+        pcb.Add(zone)
+        __AddZones(board.zones, [zone])
+        modified.append((track.layer, board.zones.Rect(len(board.zones) - 1)))
+    start = __Lap(stats, "zones", start)
+
+    if incremental_fill or board.area is not None:
+        filled = RebuildZonesInAreas(pcb, modified, board.zones)
+    else:
+        filled = RebuildAllZones(pcb)
+    __Lap(stats, "fill", start)
 
-            if not found:
-                coor = __ComputePoints(track, via, hpercent, vpercent, segs,
-                                       follow_tracks, trackLookup, noBulge)
-                if coor:
-                    pcb.Add(__Zone(pcb, coor, track))
-                    count += 1
+    if stats is not None:
+        stats.Count("zones_filled", filled)
+    return len(plan.teardrops)
 
-    RebuildAllZones(pcb)
-    return count
 
+def RmTeardrops(pcb=None, incremental_fill=False, stats=False, profile=None,
+                nets=None, layers=None, selected=False, region=None):
+    """Remove all teardrops, or only the ones passing the given filters
 
-def RmTeardrops(pcb=None):
-    """Remove all teardrops"""
+    nets and layers are collections of net names and layer ids. With
+    selected, only the teardrops of the selected vias/pads (and the
+    selected teardrops) are removed. region is a (left, top, right, bottom)
+    rectangle, in internal units, the teardrops must overlap.
+    With incremental_fill or any filter, only the zones overlapping a
+    removed teardrop are filled instead of all the zones of the board.
+    stats and profile work as for SetTeardrops.
+    """
 
     if pcb is None:
         pcb = GetBoard()
+    return __Run(__RmTeardrops, stats, profile, pcb, incremental_fill, nets,
+                 layers, selected, region)
+
+
+def __RmTeardrops(stats, pcb, incremental_fill, nets, layers, selected,
+                  region):
+    """RmTeardrops itself, stats is None when not wanted"""
+    start = time.time()
+    if nets is not None:
+        nets = set(nets)
+    if layers is not None:
+        layers = set(layers)
+    teardrops, filtered = __GetTeardrops(pcb, nets, layers, selected, region)
+    start = __Lap(stats, "gather", start)
+
+    modified = [(teardrop.GetLayer(), __BoundingRect(teardrop))
+                for teardrop in teardrops]
+    for teardrop in teardrops:
+        pcb.Remove(teardrop)
+    count = len(teardrops)
+    start = __Lap(stats, "remove", start)
+
+    partial = nets is not None or layers is not None or selected or \
+        region is not None
+    if incremental_fill or partial:
+        filled = RebuildZonesInAreas(pcb, modified)
+    else:
+        filled = RebuildAllZones(pcb)
+    __Lap(stats, "fill", start)
 
-    count = 0
-    teardrops = __GetAllTeardrops(pcb)
-    for netname in teardrops:
-        for teardrop in teardrops[netname]:
-            pcb.Remove(teardrop)
-            count += 1
-
-    RebuildAllZones(pcb)
+    if stats is not None:
+        stats.Count("teardrops", count)
+        stats.Count("filtered_out", filtered)
+        stats.Count("zones_filled", filled)
     return count
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# Benchmark of SetTeardrops and RmTeardrops on synthetic boards
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+"""Time the teardrop stages on synthetic boards of controlled size.
+
+The boards are built with the pure Python pcbnew stand-in (td_standin.py),
+so this runs headless and measures the plugin itself: zone filling is only
+recorded, not done. Run it as a script, not from inside pcbnew.
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from math import cos, sin, pi, sqrt
+
+try:
+    from . import td_standin as pcbnew
+except ImportError:
+    import td_standin as pcbnew
+
+MM = 1000000
+
+SET_STAGES = ["gather", "match", "fingerprint", "geometry", "zone_check",
+              "zones", "fill"]
+RM_STAGES = ["gather", "remove", "fill"]
+
+
+def SyntheticBoard(tracks=2000, vias=500, pads=200, smd=100, arcs=200,
+                   zones=10, layers=2, seed=0):
+    """Build a stand-in board with the given number of items.
+
+    Tracks and arcs start from vias and pads so that most of them get a
+    teardrop. The board area grows with the number of vias and pads to keep
+    the density constant.
+    """
+    rnd = random.Random(seed)
+    board = pcbnew.BOARD()
+    copper = list(range(max(layers - 1, 0))) + [pcbnew.B_Cu]
+    if layers < 2:
+        copper = [pcbnew.F_Cu]
+    nets = ["GND", "VCC"] + ["N{}".format(i)
+                             for i in range(max((vias + pads + smd) // 4, 2))]
+    side = int(sqrt(max(vias + pads + smd, 1)) * 3) * MM
+
+    def Position():
+        return (rnd.randint(0, side // 100000) * 100000,
+                rnd.randint(0, side // 100000) * 100000)
+
+    anchors = []
+    for i in range(vias):
+        net = rnd.choice(nets)
+        size = rnd.choice([0.6, 0.8, 1.0])
+        via = pcbnew.PCB_VIA(board, Position(), int(size * MM), int(0.3 * MM),
+                             net, board.NetCode(net))
+        board.Add(via)
+        anchors.append((via.GetPosition(), net, None))
+    for i in range(pads + smd):
+        net = rnd.choice(nets)
+        if i < pads:
+            pad = pcbnew.PAD(board, Position(), (int(1.7 * MM), int(1.7 * MM)),
+                             pcbnew.PAD_ATTRIB_PTH, copper, net,
+                             board.NetCode(net))
+            layer = None
+        else:
+            layer = rnd.choice([pcbnew.F_Cu, pcbnew.B_Cu])
+            pad = pcbnew.PAD(board, Position(), (int(0.6 * MM), int(1.2 * MM)),
+                             pcbnew.PAD_ATTRIB_SMD, [layer], net,
+                             board.NetCode(net))
+        board.Add(pad)
+        anchors.append((pad.GetPosition(), net, layer))
+    if not anchors:
+        return board
+
+    # Chains of 1 to 4 segments leaving an anchor
+    left = tracks
+    while left > 0:
+        pos, net, layer = rnd.choice(anchors)
+        layer = rnd.choice(copper) if layer is None else layer
+        width = int(rnd.choice([0.15, 0.2, 0.25, 0.4]) * MM)
+        angle = rnd.random() * 2 * pi
+        start = pos
+        for j in range(min(rnd.randint(1, 4), left)):
+            length = rnd.uniform(0.2, 2) * MM
+            angle += rnd.uniform(-0.5, 0.5)
+            end = (start[0] + int(length * cos(angle)),
+                   start[1] + int(length * sin(angle)))
+            board.Add(pcbnew.PCB_TRACK(board, start, end, width, layer, net,
+                                       board.NetCode(net)))
+            start = end
+            left -= 1
+
+    for i in range(arcs):
+        pos, net, layer = rnd.choice(anchors)
+        layer = rnd.choice(copper) if layer is None else layer
+        width = int(rnd.choice([0.15, 0.2, 0.25]) * MM)
+        radius = rnd.uniform(1, 4) * MM
+        angle = rnd.random() * 2 * pi
+        sweep = rnd.uniform(0.3, 1.5) * rnd.choice([-1, 1])
+        center = (pos[0] - radius * cos(angle), pos[1] - radius * sin(angle))
+        mid = (int(center[0] + radius * cos(angle + sweep / 2)),
+               int(center[1] + radius * sin(angle + sweep / 2)))
+        end = (int(center[0] + radius * cos(angle + sweep)),
+               int(center[1] + radius * sin(angle + sweep)))
+        board.Add(pcbnew.PCB_ARC(board, pos, mid, end, width, layer, net,
+                                 board.NetCode(net)))
+
+    for i in range(zones):
+        zone = pcbnew.ZONE(board)
+        net = rnd.choice(nets[:4])
+        zone.SetNetCode(board.NetCode(net))
+        zone.SetLayer(rnd.choice(copper))
+        zone.SetAssignedPriority(rnd.randint(0, 3))
+        x0, y0 = Position()
+        x1 = x0 + rnd.randint(side // 10, side // 2)
+        y1 = y0 + rnd.randint(side // 10, side // 2)
+        outline = zone.Outline()
+        outline.NewOutline()
+        for x, y in [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]:
+            outline.Append(x, y)
+        board.Add(zone)
+    return board
+
+
+def __LoadTd():
+    """Import td.py on top of the stand-in"""
+    pcbnew.Install(force=True)
+    try:
+        from . import td
+    except ImportError:
+        import td
+    return td
+
+
+def __Best(runs, action, stages):
+    """Fastest time of each stage over all the runs"""
+    return dict((stage, min(run[action]["timings"][stage] for run in runs))
+                for stage in stages)
+
+
+def Benchmark(size, repeat=3, **options):
+    """Run SetTeardrops then RmTeardrops repeat times on fresh boards"""
+    td = __LoadTd()
+    runs = []
+    for i in range(repeat):
+        pcb = SyntheticBoard(**size)
+        run = {}
+        start = time.time()
+        stats = td.SetTeardrops(pcb=pcb, stats=True, **options)
+        run["set"] = {"count": stats.count, "total": time.time() - start,
+                      "timings": stats.timings, "counters": stats.counters}
+        start = time.time()
+        stats = td.RmTeardrops(pcb=pcb, stats=True,
+                               incremental_fill=options.get(
+                                   "incremental_fill", False))
+        run["remove"] = {"count": stats.count, "total": time.time() - start,
+                         "timings": stats.timings, "counters": stats.counters}
+        runs.append(run)
+
+    return {"version": td.__version__,
+            "python": platform.python_version(),
+            "size": size,
+            "options": options,
+            "runs": runs,
+            "best": {"set": __Best(runs, "set", SET_STAGES),
+                     "remove": __Best(runs, "remove", RM_STAGES)}}
+
+
+def Main(argv=None):
+    """Run the benchmark from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Time the teardrop stages on a synthetic board and "
+                    "print the results as JSON.")
+    for name, default in [("tracks", 2000), ("vias", 500), ("pads", 200),
+                          ("smd", 100), ("arcs", 200), ("zones", 10),
+                          ("layers", 2), ("seed", 0)]:
+        parser.add_argument("--" + name, type=int, default=default)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--segs", type=int, default=10)
+    parser.add_argument("--tolerance", type=int, default=0,
+                        help="chord tolerance in nm")
+    parser.add_argument("--use-smd", action="store_true")
+    parser.add_argument("--incremental-fill", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("-o", "--output",
+                        help="write the results to this file instead of "
+                             "stdout")
+    args = parser.parse_args(argv)
+
+    size = dict((name, getattr(args, name))
+                for name in ["tracks", "vias", "pads", "smd", "arcs", "zones",
+                             "layers", "seed"])
+    result = Benchmark(size, args.repeat, segs=args.segs,
+                       tolerance=args.tolerance,
+                       use_smd=args.use_smd,
+                       incremental_fill=args.incremental_fill,
+                       workers=args.workers)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=1)
+    else:
+        json.dump(result, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# Equivalence check of td.py against the reference implementation
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+"""Check that td.py adds the teardrops td_reference.py would.
+
+Both add teardrops to copies of the same boards: random boards built with
+the pcbnew stand-in (td_standin.py), each one under several option sets
+covering follow_tracks, noBulge, SMD pads and straight teardrops, or real
+.kicad_pcb files when KiCad's pcbnew is installed. Each teardrop outline
+of td.py is paired with the closest one of the reference on the same
+layer and net; the pairs further apart than the tolerance and the
+teardrops only one side made are reported. One JSON line is printed per
+board and option set, with the time and teardrops per second of each
+side, then a summary line. The exit status is 1 when anything differs.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from math import cos, hypot, sin, pi
+
+try:
+    from . import td_standin as pcbnew
+except ImportError:
+    import td_standin as pcbnew
+
+MM = 1000000
+
+# Priority of the teardrop zones, see td.py
+MAGIC_TEARDROP_ZONE_ID = 0x4242
+
+# Grid used to pair the outlines of both sides by bounding box center
+MATCH_CELL = MM // 10
+
+# Option sets each random board is checked with
+CONFIGS = [
+    dict(),
+    dict(follow_tracks=False),
+    dict(noBulge=False, hpercent=80, vpercent=70),
+    dict(use_smd=True, segs=17),
+    dict(use_smd=True, segs=2),
+    dict(discard_in_same_zone=False, follow_tracks=False, noBulge=False),
+]
+
+
+def RandomBoard(seed, vias=60, pads=30, smd=20, zones=4):
+    """Build a stand-in board mixing the cases the teardrop code handles.
+
+    Tracks leave vias and pads straight, as chains of short segments (with
+    Y junctions at times) or as arcs, sometimes starting off the via
+    center or drawn backwards. Some SMD pads only have paste.
+    """
+    rnd = random.Random(seed)
+    board = pcbnew.BOARD()
+    nets = ["GND", "VCC"] + ["N{}".format(i) for i in range(12)]
+    copper = [pcbnew.F_Cu, 1, pcbnew.B_Cu]
+    anchors = []
+    for i in range(vias):
+        pos = (rnd.randint(0, 80) * MM + rnd.randint(0, 9) * 100000,
+               rnd.randint(0, 80) * MM + rnd.randint(0, 9) * 100000)
+        size = int(rnd.choice([0.45, 0.6, 0.8, 1.0, 1.2]) * MM)
+        net = rnd.choice(nets)
+        board.Add(pcbnew.PCB_VIA(board, pos, size, int(0.3 * MM), net,
+                                 board.NetCode(net)))
+        anchors.append((pos, size, net, None))
+    for i in range(pads + smd):
+        pos = (rnd.randint(0, 80) * MM + MM // 2,
+               rnd.randint(0, 80) * MM + MM // 2)
+        net = rnd.choice(nets)
+        if i < pads:
+            size = (int(rnd.choice([1.2, 1.5, 1.7]) * MM),
+                    int(rnd.choice([1.2, 1.5]) * MM))
+            board.Add(pcbnew.PAD(board, pos, size, pcbnew.PAD_ATTRIB_PTH,
+                                 copper, net, board.NetCode(net)))
+            layer = None
+        else:
+            size = (int(0.6 * MM), int(1.0 * MM))
+            # Some pads only have paste (F.Paste)
+            layer = 35 if rnd.random() < 0.1 else rnd.choice(
+                [pcbnew.F_Cu, pcbnew.B_Cu])
+            board.Add(pcbnew.PAD(board, pos, size, pcbnew.PAD_ATTRIB_SMD,
+                                 [layer], net, board.NetCode(net)))
+        anchors.append((pos, min(size), net, layer))
+
+    for pos, size, net, layer in anchors:
+        code = board.NetCode(net)
+        for k in range(rnd.randint(0, 3)):
+            if layer is None:
+                on = rnd.choice(copper)
+            else:
+                on = layer if layer != 35 else pcbnew.F_Cu
+            width = int(rnd.choice([0.15, 0.2, 0.25, 0.4, 0.6]) * MM)
+            angle = rnd.random() * 2 * pi
+            off = rnd.choice([0, 0, 0, rnd.randint(0, size // 3)])
+            off_angle = rnd.random() * 2 * pi
+            start = (pos[0] + int(off * cos(off_angle)),
+                     pos[1] + int(off * sin(off_angle)))
+            kind = rnd.random()
+            if kind < 0.4:
+                length = rnd.uniform(0.05, 3) * MM
+                end = (start[0] + int(length * cos(angle)),
+                       start[1] + int(length * sin(angle)))
+                if rnd.random() < 0.5:
+                    start, end = end, start
+                board.Add(pcbnew.PCB_TRACK(board, start, end, width, on, net,
+                                           code))
+            elif kind < 0.75:
+                # Chain of short segments, for follow_tracks
+                p0 = start
+                for j in range(rnd.randint(2, 5)):
+                    length = rnd.uniform(0.05, 0.5) * MM
+                    angle += rnd.uniform(-0.6, 0.6)
+                    p1 = (p0[0] + int(length * cos(angle)),
+                          p0[1] + int(length * sin(angle)))
+                    ends = (p0, p1) if rnd.random() < 0.5 else (p1, p0)
+                    board.Add(pcbnew.PCB_TRACK(board, ends[0], ends[1], width,
+                                               on, net, code))
+                    p0 = p1
+                if rnd.random() < 0.2:
+                    # Y junction
+                    for dx, dy in [(0.3, -0.2), (-0.3, 0.25)]:
+                        p1 = (p0[0] + int(dx * MM), p0[1] + int(dy * MM))
+                        board.Add(pcbnew.PCB_TRACK(board, p0, p1, width, on,
+                                                   net, code))
+            else:
+                radius = rnd.uniform(0.5, 4) * MM
+                sweep = rnd.uniform(0.2, 1.5) * rnd.choice([-1, 1])
+                center = (start[0] - radius * cos(angle),
+                          start[1] - radius * sin(angle))
+                mid = (int(center[0] + radius * cos(angle + sweep / 2)),
+                       int(center[1] + radius * sin(angle + sweep / 2)))
+                end = (int(center[0] + radius * cos(angle + sweep)),
+                       int(center[1] + radius * sin(angle + sweep)))
+                ends = (start, end) if rnd.random() < 0.7 else (end, start)
+                board.Add(pcbnew.PCB_ARC(board, ends[0], mid, ends[1], width,
+                                         on, net, code))
+                if rnd.random() < 0.5:
+                    further = (end[0] + MM // 2, end[1] + MM // 5)
+                    board.Add(pcbnew.PCB_TRACK(board, end, further, width, on,
+                                               net, code))
+
+    for i in range(zones):
+        zone = pcbnew.ZONE(board)
+        net = rnd.choice(nets[:4])
+        zone.SetNetCode(board.NetCode(net))
+        zone.SetLayer(rnd.choice(copper))
+        if rnd.random() < 0.3:
+            zone.SetLayerSet(pcbnew.LSET([pcbnew.F_Cu, pcbnew.B_Cu]))
+        zone.SetAssignedPriority(rnd.randint(0, 3))
+        x0, y0 = rnd.randint(0, 60) * MM, rnd.randint(0, 60) * MM
+        x1, y1 = x0 + rnd.randint(5, 30) * MM, y0 + rnd.randint(5, 30) * MM
+        outline = zone.Outline()
+        outline.NewOutline()
+        for x, y in [(x0, y0), (x1, y0), (x1, (y0 + y1) // 2),
+                     (x0 + 2 * MM, y1), (x0, y1)]:
+            outline.Append(x, y)
+        board.Add(zone)
+    return board
+
+
+def StripTeardrops(pcb):
+    """Remove the teardrops of a board, without filling, so that both sides
+    start from a teardrop free board"""
+    for zone in [pcb.GetArea(i) for i in range(pcb.GetAreaCount())]:
+        if zone.GetAssignedPriority() == MAGIC_TEARDROP_ZONE_ID:
+            pcb.Remove(zone)
+
+
+def Outlines(pcb):
+    """Return the (layer, net, points) of every teardrop outline"""
+    outlines = []
+    for i in range(pcb.GetAreaCount()):
+        zone = pcb.GetArea(i)
+        if zone.GetAssignedPriority() != MAGIC_TEARDROP_ZONE_ID:
+            continue
+        polygons = zone.Outline()
+        for j in range(polygons.OutlineCount()):
+            chain = polygons.Outline(j)
+            points = [chain.CPoint(k) for k in range(chain.PointCount())]
+            outlines.append((zone.GetLayer(), zone.GetNetname(),
+                             [(p.x, p.y) for p in points]))
+    return outlines
+
+
+def __Center(points):
+    """Center of the bounding box of the points"""
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs) + max(xs)) // 2, (min(ys) + max(ys)) // 2
+
+
+def __SegmentDistance(p, a, b):
+    """Distance from p to the segment ab"""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    length = dx * dx + dy * dy
+    t = 0
+    if length > 0:
+        t = max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length))
+    return hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def Deviation(a, b):
+    """Largest distance between two outlines: between matching vertices
+    when they have as many, else from any vertex to the other outline"""
+    if len(a) == len(b):
+        return max(hypot(p[0] - q[0], p[1] - q[1]) for p, q in zip(a, b))
+    return max(max(min(__SegmentDistance(p, other[i - 1], other[i])
+                       for i in range(len(other))) for p in outline)
+               for outline, other in [(a, b), (b, a)])
+
+
+def Compare(reference, optimized, tolerance):
+    """Pair the outlines of both sides, return the differences and the
+    largest deviation of the pairs"""
+    index = {}
+    for i, (layer, net, points) in enumerate(reference):
+        x, y = __Center(points)
+        key = (layer, net, x // MATCH_CELL, y // MATCH_CELL)
+        index.setdefault(key, []).append(i)
+
+    paired = set()
+    differences = []
+    worst = 0
+    for layer, net, points in optimized:
+        x, y = __Center(points)
+        best = None
+        for cx in range(x // MATCH_CELL - 1, x // MATCH_CELL + 2):
+            for cy in range(y // MATCH_CELL - 1, y // MATCH_CELL + 2):
+                for i in index.get((layer, net, cx, cy), ()):
+                    if i in paired:
+                        continue
+                    rx, ry = __Center(reference[i][2])
+                    distance = hypot(rx - x, ry - y)
+                    if best is None or distance < best[0]:
+                        best = (distance, i)
+        where = {"layer": layer, "net": net, "x": x / MM, "y": y / MM}
+        if best is None:
+            differences.append(dict(where, kind="extra"))
+            continue
+        paired.add(best[1])
+        deviation = Deviation(reference[best[1]][2], points)
+        worst = max(worst, deviation)
+        if deviation > tolerance:
+            differences.append(dict(where, kind="moved",
+                                    deviation=round(deviation, 1),
+                                    points=[len(reference[best[1]][2]),
+                                            len(points)]))
+    for i, (layer, net, points) in enumerate(reference):
+        if i not in paired:
+            x, y = __Center(points)
+            differences.append({"layer": layer, "net": net, "x": x / MM,
+                                "y": y / MM, "kind": "missing"})
+    return differences, worst
+
+
+def __Timed(module, pcb, options):
+    """Add the teardrops of one side, return its report"""
+    start = time.time()
+    try:
+        count = int(module.SetTeardrops(pcb=pcb, **options))
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+    seconds = time.time() - start
+    return {"count": count, "seconds": round(seconds, 6),
+            "per_second": round(count / seconds, 1) if seconds > 0 else None}
+
+
+def CheckBoard(name, load, options, optimized, td, reference, tolerance,
+               show=10):
+    """Check one board under one option set, load giving fresh copies.
+
+    optimized holds the extra options of the td.py side only, like workers
+    or shape_cache. Return the report of the check.
+    """
+    boards = []
+    for side in range(2):
+        pcb = load()
+        StripTeardrops(pcb)
+        boards.append(pcb)
+    report = {"board": name, "options": options}
+    report["reference"] = __Timed(reference, boards[0], options)
+    report["td"] = __Timed(td, boards[1], dict(options, **optimized))
+
+    errors = [report[side].get("error") for side in ("reference", "td")]
+    if errors[0] or errors[1]:
+        # Failing the same way is still equivalent
+        same = [e and e.split(":")[0] for e in errors]
+        report["differences"] = int(same[0] != same[1])
+        return report
+    differences, worst = Compare(Outlines(boards[0]), Outlines(boards[1]),
+                                 tolerance)
+    report["differences"] = len(differences)
+    report["max_deviation"] = round(worst, 1)
+    if differences:
+        report["details"] = differences[:show]
+    return report
+
+
+def __LoadModules(standin):
+    """Import td.py and td_reference.py, on top of the stand-in if asked"""
+    if standin:
+        pcbnew.Install(force=True)
+    try:
+        from . import td, td_reference
+    except ImportError:
+        import td
+        import td_reference
+    return td, td_reference
+
+
+def Main(argv=None):
+    """Run the check from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Compare the teardrops of td.py with the ones of the "
+                    "reference implementation. One JSON line is printed per "
+                    "board and option set.")
+    parser.add_argument("boards", nargs="*", metavar="BOARD",
+                        help=".kicad_pcb file to check, needs KiCad's "
+                             "pcbnew (default: random stand-in boards)")
+    parser.add_argument("--random", type=int, default=20,
+                        help="number of random boards (default: 20)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first random board")
+    parser.add_argument("--tolerance", type=float, default=1,
+                        help="largest vertex difference allowed, in nm "
+                             "(default: 1)")
+    parser.add_argument("--show", type=int, default=10,
+                        help="differences listed per board and option set")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes computing the shapes on the td.py "
+                             "side")
+    parser.add_argument("--shape-cache", action="store_true",
+                        help="use a shape cache on the td.py side")
+    parser.add_argument("--chord-tolerance", type=int, default=0,
+                        help="tolerance in nm of the td.py curves (default: "
+                             "off)")
+    args = parser.parse_args(argv)
+
+    optimized = {"workers": args.workers}
+    if args.chord_tolerance:
+        optimized["tolerance"] = args.chord_tolerance
+    cases = []
+    if args.boards:
+        try:
+            import pcbnew as kicad
+        except ImportError:
+            parser.error("checking .kicad_pcb files needs KiCad's pcbnew")
+        td, reference = __LoadModules(False)
+        for path in args.boards:
+            for options in CONFIGS:
+                cases.append((path, lambda path=path: kicad.LoadBoard(path),
+                              options))
+    else:
+        td, reference = __LoadModules(True)
+        for seed in range(args.seed, args.seed + args.random):
+            for options in CONFIGS:
+                cases.append(("random:{}".format(seed),
+                              lambda seed=seed: RandomBoard(seed), options))
+
+    failed = 0
+    seconds = {"reference": 0, "td": 0}
+    counts = {"reference": 0, "td": 0}
+    for name, load, options in cases:
+        if args.shape_cache:
+            # A fresh cache per board, it must not hide a difference
+            optimized["shape_cache"] = td.ShapeCache()
+        report = CheckBoard(name, load, options, optimized, td, reference,
+                            args.tolerance, args.show)
+        failed += report["differences"] > 0
+        for side in seconds:
+            seconds[side] += report[side].get("seconds", 0)
+            counts[side] += report[side].get("count", 0)
+        print(json.dumps(report), flush=True)
+
+    summary = {"checks": len(cases), "failed": failed}
+    for side in seconds:
+        summary[side] = {"count": counts[side],
+                         "seconds": round(seconds[side], 3),
+                         "per_second": round(counts[side] / seconds[side], 1)
+                         if seconds[side] > 0 else None}
+    print(json.dumps({"summary": summary}), flush=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# This is the command line interface, for batch processing of boards
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+import argparse
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from .td_pcbfile import PreviewFile
+except ImportError:
+    # Run as a script, td_pcbfile.py is next to this file
+    from td_pcbfile import PreviewFile
+
+
+# Internal units (nm) per mm
+IU_PER_MM = 1000000
+
+
+def LoadTd():
+    """Import td.py, which needs the pcbnew module of KiCad"""
+    try:
+        from . import td
+    except ImportError:
+        # Run as a script, td.py is next to this file
+        import td
+    return td
+
+
+def ParseRegion(text):
+    """Parse a LEFT,TOP,RIGHT,BOTTOM rectangle in mm"""
+    try:
+        left, top, right, bottom = [float(v) for v in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected LEFT,TOP,RIGHT,BOTTOM in mm, got {!r}".format(text))
+    return left, top, right, bottom
+
+
+def ParseArgs(argv=None):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(
+        description="Add or remove teardrops on KiCad boards. One JSON line "
+                    "is printed per board.")
+    parser.add_argument("boards", nargs="+", metavar="BOARD",
+                        help=".kicad_pcb file to process")
+    parser.add_argument("--remove", action="store_true",
+                        help="remove the teardrops instead of adding them")
+    parser.add_argument("--net", dest="nets", action="append",
+                        metavar="NET",
+                        help="with --remove, only remove the teardrops of "
+                             "this net (repeatable)")
+    parser.add_argument("--layer", dest="layers", action="append",
+                        metavar="LAYER",
+                        help="with --remove, only remove the teardrops on "
+                             "this layer, like F.Cu (repeatable)")
+    parser.add_argument("--region", type=ParseRegion,
+                        metavar="LEFT,TOP,RIGHT,BOTTOM",
+                        help="only add teardrops to the vias/pads centered "
+                             "in this rectangle, or with --remove only remove "
+                             "the teardrops overlapping it, in mm")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+                        help="only compute and count the teardrops, the "
+                             "boards are not saved")
+    parser.add_argument("--headless", action="store_true",
+                        help="like --dry-run, but read the board files "
+                             "directly instead of loading them in pcbnew, "
+                             "so KiCad is not needed")
+    parser.add_argument("--stream", action="store_true",
+                        help="write the teardrop zones straight into the "
+                             "board file instead of building them in pcbnew, "
+                             "then fill the zones of the file")
+    parser.add_argument("-o", "--output-dir",
+                        help="save the boards in this directory instead of "
+                             "overwriting them")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="boards processed in parallel (default: one "
+                             "per CPU)")
+    parser.add_argument("--hpercent", type=int, default=50,
+                        help="teardrop length, in %% of the via/pad size")
+    parser.add_argument("--vpercent", type=int, default=90,
+                        help="teardrop width, in %% of the via/pad size")
+    parser.add_argument("--segs", type=int, default=10,
+                        help="segments per teardrop curve, 2 for straight "
+                             "teardrops")
+    parser.add_argument("--tolerance", type=float, default=0,
+                        help="largest distance in um between the teardrop "
+                             "outline and its curves, --segs being then the "
+                             "maximum number of segments (default: off)")
+    parser.add_argument("--use-smd", action="store_true",
+                        help="also add teardrops to SMD pads")
+    parser.add_argument("--keep-in-same-zone", dest="discard_in_same_zone",
+                        action="store_false",
+                        help="add teardrops even when the via and the track "
+                             "are in a zone of the same net")
+    parser.add_argument("--no-follow-tracks", dest="follow_tracks",
+                        action="store_false",
+                        help="do not follow the tracks shorter than the "
+                             "teardrop")
+    parser.add_argument("--bulge", dest="noBulge", action="store_false",
+                        help="allow the teardrops to bulge")
+    parser.add_argument("--update", action="store_true",
+                        help="only redo the teardrops whose via/pad, track or "
+                             "settings changed since the last run")
+    parser.add_argument("--incremental-fill", action="store_true",
+                        help="only refill the zones around modified "
+                             "teardrops")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes computing the teardrop shapes of "
+                             "each board")
+    parser.add_argument("--shape-cache", action="store_true",
+                        help="reuse the outlines of straight teardrops of the "
+                             "same shape, kept next to each board")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a cProfile dump of each board next to "
+                             "its output, as <output>.prof")
+    args = parser.parse_args(argv)
+    if (args.nets or args.layers) and not args.remove:
+        parser.error("--net and --layer only work with --remove")
+    if args.incremental_fill and (args.stream or args.dry_run or
+                                  args.headless):
+        parser.error("--incremental-fill does not work with --stream, "
+                     "--dry-run or --headless")
+    if args.headless:
+        if args.remove or args.stream or args.update:
+            parser.error("--headless only works when adding teardrops, "
+                         "without --stream or --update")
+        args.dry_run = True
+    if args.dry_run and args.remove:
+        parser.error("--dry-run only works when adding teardrops")
+    if args.stream and (args.remove or args.dry_run or args.update):
+        parser.error("--stream only works when adding teardrops, without "
+                     "--update")
+    return args
+
+
+def RunAction(pcb, args, profile, region):
+    """Add, preview or remove the teardrops of a loaded board"""
+    td = LoadTd()
+    if args.remove:
+        layers = None
+        if args.layers:
+            layers = [pcb.GetLayerID(name) for name in args.layers]
+            if min(layers) < 0:
+                raise ValueError("unknown layer in {}".format(
+                    ", ".join(args.layers)))
+        return td.RmTeardrops(pcb=pcb, incremental_fill=args.incremental_fill,
+                              stats=True, profile=profile, nets=args.nets,
+                              layers=layers, region=region)
+    if args.dry_run:
+        return td.PreviewTeardrops(args.hpercent, args.vpercent, args.segs,
+                                   pcb, args.use_smd,
+                                   args.discard_in_same_zone,
+                                   args.follow_tracks, args.noBulge,
+                                   workers=args.workers, profile=profile,
+                                   update=args.update,
+                                   shape_cache=args.shape_cache or None,
+                                   tolerance=int(args.tolerance * 1000),
+                                   region=region)
+    return td.SetTeardrops(args.hpercent, args.vpercent, args.segs, pcb,
+                           args.use_smd, args.discard_in_same_zone,
+                           args.follow_tracks, args.noBulge,
+                           incremental_fill=args.incremental_fill,
+                           workers=args.workers, stats=True, profile=profile,
+                           update=args.update,
+                           shape_cache=args.shape_cache or None,
+                           tolerance=int(args.tolerance * 1000), region=region)
+
+
+def RunHeadless(path, args, profile, region):
+    """Preview the teardrops of a board file, read without pcbnew"""
+    run = functools.partial(PreviewFile, path, args.hpercent, args.vpercent,
+                            args.segs, args.use_smd, args.discard_in_same_zone,
+                            args.follow_tracks, args.noBulge, args.workers,
+                            args.shape_cache or None,
+                            int(args.tolerance * 1000), region)
+    if profile is None:
+        return run()
+    profiler = cProfile.Profile()
+    stats = profiler.runcall(run)
+    profiler.dump_stats(profile)
+    return stats
+
+
+def ProcessBoard(path, args):
+    """Load, process and save one board, return its report"""
+    if not args.headless:
+        import pcbnew
+
+    report = {"board": path, "action": "remove" if args.remove else "set"}
+    if args.dry_run:
+        report["action"] = "preview"
+    output = path
+    if args.output_dir:
+        output = os.path.join(args.output_dir, os.path.basename(path))
+    try:
+        start = time.time()
+        profile = output + ".prof" if args.profile else None
+        region = None
+        if args.region:
+            region = [int(round(v * IU_PER_MM)) for v in args.region]
+        if args.headless:
+            # Reading the file is part of the run, there is nothing to save
+            stats = RunHeadless(path, args, profile, region)
+            output = None
+            loaded = start + stats.timings["read"]
+            processed = saved = time.time()
+        elif args.stream:
+            # Loading and saving happen inside, the zones are written as text
+            stats = LoadTd().WriteTeardrops(
+                path, output, args.hpercent, args.vpercent, args.segs,
+                args.use_smd, args.discard_in_same_zone, args.follow_tracks,
+                args.noBulge, workers=args.workers, stats=True,
+                profile=profile, shape_cache=args.shape_cache or None,
+                tolerance=int(args.tolerance * 1000), region=region)
+            loaded = start
+            processed = saved = time.time()
+        else:
+            pcb = pcbnew.LoadBoard(path)
+            if pcb is None:
+                raise IOError("cannot load {}".format(path))
+            loaded = time.time()
+            stats = RunAction(pcb, args, profile, region)
+            processed = time.time()
+            if args.dry_run:
+                output = None
+            else:
+                pcbnew.SaveBoard(output, pcb)
+            saved = time.time()
+    except Exception as e:
+        report["error"] = str(e)
+        return report
+
+    report.update({"output": output, "count": stats.count,
+                   "load": round(loaded - start, 6),
+                   "process": round(processed - loaded, 6),
+                   "save": round(saved - processed, 6),
+                   "stages": dict((stage, round(t, 6))
+                                  for stage, t in stats.timings.items()),
+                   "counters": stats.counters})
+    return report
+
+
+def Main(argv=None):
+    """Process all the boards given on the command line"""
+    args = ParseArgs(argv)
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    jobs = min(args.jobs or os.cpu_count() or 1, len(args.boards))
+    if jobs > 1:
+        pool = ProcessPoolExecutor(jobs)
+        reports = pool.map(ProcessBoard, args.boards,
+                           [args] * len(args.boards))
+    else:
+        pool = None
+        reports = (ProcessBoard(path, args) for path in args.boards)
+
+    failed = 0
+    for report in reports:
+        failed += "error" in report
+        print(json.dumps(report), flush=True)
+    if pool is not None:
+        pool.shutdown()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
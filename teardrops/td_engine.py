@@ -0,0 +1,1336 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# This is the geometry core, free of any pcbnew object
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+"""Teardrop geometry working on plain records instead of pcbnew objects.
+
+Points are (x, y) tuples in internal units. Integer coordinates are
+obtained with int(), like the wxPoint built by the original code.
+Vias and pads are (position, size, drill, layer) tuples.
+"""
+
+import hashlib
+import json
+import os
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from math import cos, sin, asin, atan2, ceil, hypot, sqrt, pi
+
+try:
+    import numpy
+except ImportError:
+    # Curves are then evaluated in pure Python
+    numpy = None
+
+# Flags returned by IsPointOnEnds
+STARTPOINT = 1
+ENDPOINT = 2
+
+# Step used to find where a track leaves the via: 0.01mm in nm
+BACKOFF_STEP = 10000
+
+# Below this number of candidates, starting a process pool costs more
+# than it saves
+POOL_MIN_CANDIDATES = 2000
+
+# Number of items between two progress reports
+PROGRESS_STEP = 256
+
+# Cell size of the track endpoint map, in nm. Tracks touch when their ends
+# are within 10 nm and coordinates are integers, so the 3x3 cells around
+# an endpoint hold all the tracks touching it.
+ENDPOINT_GRID = 10
+
+# Zone name of the teardrops, followed by "<via x>,<via y>:<fingerprint>"
+FINGERPRINT_PREFIX = "teardrop:"
+
+# Priority of the teardrop zones, which tells them from the other zones
+MAGIC_TEARDROP_ZONE_ID = 0x4242
+
+# Kinds of TrackTable rows (TRACK, ARC, VIA) and ViaTable rows (VIA, PAD_*)
+TRACK = 0
+ARC = 1
+VIA = 2
+PAD_PTH = 3
+PAD_SMD = 4
+
+
+class Track(object):
+    """Plain copy of a track, arc or via.
+
+    For arcs, angles are in tenths of degree: angle is the included angle
+    (negative if anticlockwise), start_angle and end_angle are the absolute
+    angles of the ends. item keeps the originating board object, if any.
+    """
+    __slots__ = ("start", "end", "width", "layer", "net", "length",
+                 "is_arc", "center", "radius", "angle", "start_angle",
+                 "end_angle", "item", "row")
+
+    def __init__(self, start, end, width, layer, net, length, item=None,
+                 row=-1):
+        self.row = row
+        self.start = start
+        self.end = end
+        self.width = width
+        self.layer = layer
+        self.net = net
+        self.length = length
+        self.is_arc = False
+        self.center = None
+        self.radius = 0
+        self.angle = 0
+        self.start_angle = 0
+        self.end_angle = 0
+        self.item = item
+
+    def SetArc(self, center, radius, angle, start_angle, end_angle):
+        """Turn the track into an arc"""
+        self.is_arc = True
+        self.center = center
+        self.radius = radius
+        self.angle = angle
+        self.start_angle = start_angle
+        self.end_angle = end_angle
+
+
+class TrackTable(object):
+    """Column storage of the tracks, arcs and vias of a board.
+
+    Net names are interned in nets. Arc parameters live in their own
+    columns, arc[row] being the arc index (-1 for other kinds). Track
+    records are only built on demand by Record.
+    """
+
+    def __init__(self):
+        self.kind = array('b')
+        self.x0 = array('q')
+        self.y0 = array('q')
+        self.x1 = array('q')
+        self.y1 = array('q')
+        self.width = array('q')
+        self.layer = array('i')
+        self.net = array('i')
+        self.length = array('d')
+        self.arc = array('i')
+        self.arc_cx = array('q')
+        self.arc_cy = array('q')
+        self.arc_radius = array('d')
+        self.arc_angle = array('d')
+        self.arc_start = array('d')
+        self.arc_end = array('d')
+        self.nets = []
+        self.net_ids = {}
+        self.items = []
+        self.records = []
+
+    def __len__(self):
+        return len(self.kind)
+
+    def __getstate__(self):
+        # Board objects cannot be sent to other processes
+        state = self.__dict__.copy()
+        state["items"] = [None] * len(self.items)
+        state["records"] = [None] * len(self.records)
+        return state
+
+    def NetId(self, net):
+        """Intern the net name"""
+        if net not in self.net_ids:
+            self.net_ids[net] = len(self.nets)
+            self.nets.append(net)
+        return self.net_ids[net]
+
+    def Append(self, kind, start, end, width, layer, net, length, item=None):
+        """Add a row, return its index"""
+        self.kind.append(kind)
+        self.x0.append(start[0])
+        self.y0.append(start[1])
+        self.x1.append(end[0])
+        self.y1.append(end[1])
+        self.width.append(width)
+        self.layer.append(layer)
+        self.net.append(self.NetId(net))
+        self.length.append(length)
+        self.arc.append(-1)
+        self.items.append(item)
+        self.records.append(None)
+        return len(self.kind) - 1
+
+    def SetArc(self, row, center, radius, angle, start_angle, end_angle):
+        """Add the arc parameters of the given row"""
+        self.arc[row] = len(self.arc_cx)
+        self.arc_cx.append(center[0])
+        self.arc_cy.append(center[1])
+        self.arc_radius.append(radius)
+        self.arc_angle.append(angle)
+        self.arc_start.append(start_angle)
+        self.arc_end.append(end_angle)
+
+    def Record(self, row):
+        """Return the (cached) Track record of the given row"""
+        track = self.records[row]
+        if track is None:
+            track = Track((self.x0[row], self.y0[row]),
+                          (self.x1[row], self.y1[row]), self.width[row],
+                          self.layer[row], self.nets[self.net[row]],
+                          self.length[row], self.items[row], row)
+            a = self.arc[row]
+            if a >= 0:
+                track.SetArc((self.arc_cx[a], self.arc_cy[a]),
+                             self.arc_radius[a], self.arc_angle[a],
+                             self.arc_start[a], self.arc_end[a])
+            self.records[row] = track
+        return track
+
+
+class ViaTable(object):
+    """Column storage of the vias and pads of a board.
+
+    layer is -1 for items on all copper layers (vias, through hole pads).
+    """
+
+    def __init__(self):
+        self.kind = array('b')
+        self.x = array('q')
+        self.y = array('q')
+        self.size = array('q')
+        self.drill = array('q')
+        self.layer = array('i')
+        self.selected = array('b')
+        self.items = []
+
+    def __len__(self):
+        return len(self.kind)
+
+    def Append(self, kind, pos, size, drill, layer, selected, item=None):
+        """Add a row, return its index"""
+        self.kind.append(kind)
+        self.x.append(pos[0])
+        self.y.append(pos[1])
+        self.size.append(size)
+        self.drill.append(drill)
+        self.layer.append(layer)
+        self.selected.append(1 if selected else 0)
+        self.items.append(item)
+        return len(self.kind) - 1
+
+    def Via(self, row):
+        """Return the (position, size, drill, layer) tuple of the row"""
+        return ((self.x[row], self.y[row]), self.size[row], self.drill[row],
+                self.layer[row])
+
+    def Rows(self, kinds, selected=False, region=None):
+        """Return the rows of the given kinds, optionally selected only or
+        centered in the (left, top, right, bottom) region only"""
+        kinds = set(kinds)
+        rows = [i for i in range(len(self.kind)) if self.kind[i] in kinds
+                and (self.selected[i] or not selected)]
+        if region is not None:
+            left, top, right, bottom = region
+            rows = [i for i in rows if left <= self.x[i] <= right and
+                    top <= self.y[i] <= bottom]
+        return rows
+
+
+class ZoneTable(object):
+    """Column storage of the zones of a board.
+
+    layers holds the copper layers of each zone and the bounding box is
+    split in left, top, right and bottom columns.
+    """
+
+    def __init__(self):
+        self.priority = array('q')
+        self.left = array('q')
+        self.top = array('q')
+        self.right = array('q')
+        self.bottom = array('q')
+        self.nets = []
+        self.layers = []
+        self.names = []
+        self.items = []
+
+    def __len__(self):
+        return len(self.priority)
+
+    def Append(self, priority, net, layers, rect, item=None, name=""):
+        """Add a row, return its index"""
+        self.priority.append(priority)
+        self.nets.append(net)
+        self.names.append(name)
+        self.layers.append(tuple(layers))
+        self.left.append(rect[0])
+        self.top.append(rect[1])
+        self.right.append(rect[2])
+        self.bottom.append(rect[3])
+        self.items.append(item)
+        return len(self.priority) - 1
+
+    def Rect(self, row):
+        """Return the (left, top, right, bottom) bounding box of the row"""
+        return (self.left[row], self.top[row], self.right[row],
+                self.bottom[row])
+
+
+class Stats(object):
+    """Stage timings and counters of a SetTeardrops or RmTeardrops run.
+
+    When asked for, it is returned instead of the teardrop count, which
+    int() gives back. After a preview, outlines holds the (layer, net,
+    points) of each teardrop that would be added.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.timings = {}
+        self.counters = {}
+        self.outlines = []
+
+    def __int__(self):
+        return self.count
+
+    def Lap(self, stage, start):
+        """Add the time elapsed since start to a stage, return the time"""
+        now = time.time()
+        self.timings[stage] = self.timings.get(stage, 0) + now - start
+        return now
+
+    def Count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def Split(self, stage, timings):
+        """Add the timings of the steps of a stage, as "stage/step" entries
+        left out of the total"""
+        for step, t in timings.items():
+            key = stage + "/" + step
+            self.timings[key] = self.timings.get(key, 0) + t
+
+    def Merge(self, counters):
+        """Add counters gathered elsewhere, e.g. in a worker process"""
+        for counter, n in counters.items():
+            self.Count(counter, n)
+
+    def Summary(self):
+        """Text table of the timings and counters"""
+        rows = [("stage", "seconds")]
+        rows += [(stage, "{:.3f}".format(t))
+                 for stage, t in self.timings.items()]
+        total = sum(t for stage, t in self.timings.items() if "/" not in stage)
+        rows += [("total", "{:.3f}".format(total)),
+                 None, ("counter", "value")]
+        rows += [(counter, str(n)) for counter, n in self.counters.items()]
+        width = max(len(row[0]) for row in rows if row)
+        return "\n".join("{:<{}}  {:>9}".format(row[0], width, row[1])
+                         if row else "" for row in rows)
+
+
+class BoardData(object):
+    """Tables of a board snapshot.
+
+    area is the (left, top, right, bottom) rectangle the tracks and zones
+    were limited to, None when they cover the whole board. timings holds
+    the time spent copying each kind of item.
+    """
+
+    def __init__(self):
+        self.tracks = TrackTable()
+        self.vias = ViaTable()
+        self.zones = ZoneTable()
+        self.area = None
+        self.timings = {}
+
+
+class Plan(object):
+    """Teardrops computed from a board snapshot, not on the board yet.
+
+    teardrops holds (track record, outline, zone name) tuples and stale the
+    rows of board.zones holding teardrops to remove. stats is the Stats
+    object of the run, None when not wanted.
+    """
+
+    def __init__(self, pcb, board, stats=None):
+        self.pcb = pcb
+        self.board = board
+        self.stats = stats
+        self.teardrops = []
+        self.stale = []
+
+
+def Pipeline(items, stages, stats=None, counter=None):
+    """Yield the items passing every (counter, keep) stage, in order.
+
+    Stages are chained generators, cheapest first: an item stops at the
+    first keep returning False, so the costlier stages only see the items
+    the cheaper ones let through. Once the items are exhausted, stats gets
+    the number of items each stage dropped under its counter, and the
+    number of items in under counter if given.
+    """
+    dropped = [0] * len(stages)
+    seen = [0]
+
+    def Count(items):
+        for item in items:
+            seen[0] += 1
+            yield item
+
+    def Filter(items, i, keep):
+        for item in items:
+            if keep(item):
+                yield item
+            else:
+                dropped[i] += 1
+
+    items = Count(items)
+    for i, (_, keep) in enumerate(stages):
+        items = Filter(items, i, keep)
+    for item in items:
+        yield item
+    if stats is not None:
+        if counter is not None:
+            stats.Count(counter, seen[0])
+        for (name, _), n in zip(stages, dropped):
+            stats.Count(name, n)
+
+
+def PointDistance(a, b):
+    """Distance between two points"""
+    return sqrt((a[0]-b[0])*(a[0]-b[0]) + (a[1]-b[1])*(a[1]-b[1]))
+
+
+def NormalizeVector(pt):
+    """Make vector unit length"""
+    norm = sqrt(pt[0] * pt[0] + pt[1] * pt[1])
+    return [t / norm for t in pt]
+
+
+def IsPointOnEnds(track, point, min_dist):
+    """Return STARTPOINT and/or ENDPOINT flags if the point is within
+    min_dist (distance rounded to the nearest unit) of the track ends"""
+    result = 0
+    if min_dist == 0:
+        if track.start == point:
+            result |= STARTPOINT
+        if track.end == point:
+            result |= ENDPOINT
+        return result
+    # min_dist >= round(distance) is distance < min_dist + 0.5
+    limit = (min_dist + 0.5) * (min_dist + 0.5)
+    for p, flag in ((track.start, STARTPOINT), (track.end, ENDPOINT)):
+        dx, dy = p[0] - point[0], p[1] - point[1]
+        if dx*dx + dy*dy < limit:
+            result |= flag
+    return result
+
+
+__bernstein_matrices = {}
+
+
+def BernsteinMatrix(segs):
+    """Return the (segs+1) x 4 cubic Bernstein weights, memoized"""
+    if segs not in __bernstein_matrices:
+        n = float(segs)
+        weights = []
+        for i in range(int(n)+1):
+            t = i/n
+            a = (1.0 - t)**3
+            b = 3.0 * t * (1.0-t)**2
+            c = 3.0 * t**2 * (1.0-t)
+            d = t**3
+            weights.append((a, b, c, d))
+        __bernstein_matrices[segs] = weights
+    return __bernstein_matrices[segs]
+
+
+def Beziers(curves, segs):
+    """Evaluate all the given cubic curves (4 control points each) at once.
+    Return a list of (x, y) integer points per curve"""
+    weights = BernsteinMatrix(segs)
+    if len(curves) == 0:
+        return []
+
+    if numpy is not None:
+        w = numpy.array(weights)
+        ctrl = numpy.array(curves, dtype=float)
+        # Sum the terms one by one, in the same order as the pure Python
+        # version, so both give exactly the same coordinates
+        pts = w[:, 0, None] * ctrl[:, None, 0, :]
+        for k in range(1, 4):
+            pts = pts + w[:, k, None] * ctrl[:, None, k, :]
+        return [[tuple(p) for p in curve]
+                for curve in pts.astype(numpy.int64).tolist()]
+
+    beziers = []
+    for p1, p2, p3, p4 in curves:
+        beziers.append([(int(a * p1[0] + b * p2[0] + c * p3[0] + d * p4[0]),
+                         int(a * p1[1] + b * p2[1] + c * p3[1] + d * p4[1]))
+                        for a, b, c, d in weights])
+    return beziers
+
+
+def ComputeCurved(vpercent, w, vec, via, pts):
+    """Compute the control points of the two curves"""
+
+    # A and B are points on the track
+    # C and E are points on the via
+    # D is midpoint behind the via centre
+
+    radius = via[1]/2
+    minVpercent = float(w*2) / float(via[1])
+    weaken = (vpercent/100.0 - minVpercent) / (1-minVpercent) / radius
+
+    biasBC = 0.5 * PointDistance(pts[1], pts[2])
+    biasAE = 0.5 * PointDistance(pts[4], pts[0])
+
+    vecC = (pts[2][0] - via[0][0], pts[2][1] - via[0][1])
+    tangentC = (pts[2][0] - vecC[1]*biasBC*weaken,
+                pts[2][1] + vecC[0]*biasBC*weaken)
+    vecE = (pts[4][0] - via[0][0], pts[4][1] - via[0][1])
+    tangentE = (pts[4][0] + vecE[1]*biasAE*weaken,
+                pts[4][1] - vecE[0]*biasAE*weaken)
+
+    tangentB = (pts[1][0] - vec[0]*biasBC, pts[1][1] - vec[1]*biasBC)
+    tangentA = (pts[0][0] - vec[0]*biasAE, pts[0][1] - vec[1]*biasAE)
+
+    curve1 = (pts[1], tangentB, tangentC, pts[2])
+    curve2 = (pts[4], tangentE, tangentA, pts[0])
+
+    return curve1, curve2
+
+
+def CurveSegments(curve, tolerance, segs):
+    """Number of segments, at most segs, keeping the chords of a cubic
+    curve within tolerance of it"""
+    p1, p2, p3, p4 = curve
+    # The second derivative is at most 6 times the largest second
+    # difference of the control points, and the chord of a piece of
+    # parameter length 1/n strays at most 1/(8 n^2) of it from the curve
+    dd = max(hypot(p1[0] - 2*p2[0] + p3[0], p1[1] - 2*p2[1] + p3[1]),
+             hypot(p2[0] - 2*p3[0] + p4[0], p2[1] - 2*p3[1] + p4[1]))
+    return max(1, min(segs, int(ceil(sqrt(0.75 * dd / tolerance)))))
+
+
+def DropCollinear(points, tolerance):
+    """Drop the points of an outline within tolerance of the line joining
+    the points kept around them. The ends are always kept"""
+    if len(points) < 3:
+        return points
+    kept = [points[0]]
+    first = 1
+    for i in range(1, len(points) - 1):
+        ax, ay = kept[-1]
+        dx, dy = points[i+1][0] - ax, points[i+1][1] - ay
+        # Distances to the line times its length, newest point first
+        limit = tolerance * hypot(dx, dy)
+        for j in range(i, first - 1, -1):
+            x, y = points[j]
+            if abs((x - ax)*dy - (y - ay)*dx) > limit:
+                kept.append(points[i])
+                first = i + 1
+                break
+    kept.append(points[-1])
+    return kept
+
+
+def BuildOutlines(teardrops, segs, tolerance=0):
+    """Return the outline points of all the (pts, curves) teardrops.
+    The curves of the whole run are evaluated in a single batch.
+
+    With a tolerance (in nm), segs is the largest number of segments per
+    curve: each curve gets the fewest segments keeping the outline within
+    tolerance/2 of it, and the curved outlines then lose the points
+    within tolerance/2 of their neighbours.
+    """
+    curves = [c for pts, cs in teardrops if cs is not None for c in cs]
+    if tolerance:
+        # One batch per number of segments
+        groups = {}
+        for i, curve in enumerate(curves):
+            n = CurveSegments(curve, tolerance/2.0, segs)
+            groups.setdefault(n, []).append(i)
+        beziers = [None] * len(curves)
+        for n, rows in groups.items():
+            for i, points in zip(rows, Beziers([curves[i] for i in rows], n)):
+                beziers[i] = points
+        beziers = iter(beziers)
+    else:
+        beziers = iter(Beziers(curves, segs))
+    outlines = []
+    for pts, cs in teardrops:
+        if cs is None:
+            outlines.append(pts)
+        else:
+            outline = next(beziers) + [pts[3]] + next(beziers)
+            if tolerance:
+                outline = DropCollinear(outline, tolerance/2.0)
+            outlines.append(outline)
+    return outlines
+
+
+class ShapeCache(object):
+    """LRU cache of canonical teardrop outlines.
+
+    Only straight tracks long enough not to be followed are cached. The
+    shape of such a teardrop only depends on where the track leaves the
+    via. Outlines are stored for a via at the origin and a track along +x,
+    keyed by (track width, via size, hpercent, vpercent, segs, tolerance,
+    noBulge, follow_tracks, off-axis angle bucket, exit distance bucket), then
+    rotated and moved into place. The off-axis angle, between the track and
+    the direction from the via center to the track exit, is rounded to
+    angle_step degrees and the exit distance to 1 um, so outlines may
+    differ from the ones computed directly by about 0.2% of the via size
+    with the default angle_step and hpercent: 1 um for a 0.6 mm via, 6 um
+    for a 3 mm pad. Slot places a teardrop in the cache, Get returns its
+    outline if cached and Put stores the outline once computed.
+    """
+
+    VERSION = 2
+
+    def __init__(self, size=4096, angle_step=0.25):
+        self.size = size
+        self.angle_step = angle_step
+        self.shapes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def Load(self, path):
+        """Load the shapes saved in path, if any and compatible"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if data.get("version") != self.VERSION or \
+           data.get("angle_step") != self.angle_step:
+            return False
+        for key, outline in data["shapes"]:
+            self.__Put(tuple(key), outline and [tuple(p) for p in outline])
+        return True
+
+    def Save(self, path):
+        """Save the shapes to path, least recently used first"""
+        with open(path, "w") as f:
+            json.dump({"version": self.VERSION,
+                       "angle_step": self.angle_step,
+                       "shapes": list(self.shapes.items())}, f)
+
+    def __Put(self, key, outline):
+        self.shapes[key] = outline
+        self.shapes.move_to_end(key)
+        while len(self.shapes) > self.size:
+            self.shapes.popitem(last=False)
+
+    def Slot(self, track, via, hpercent, vpercent, segs, follow_tracks,
+             noBulge, tolerance=0):
+        """Return the (key, via center, track direction) of the teardrop,
+        None if it is not one the cache handles"""
+        if track.is_arc:
+            return None
+        radius = via[1]/2.0
+        start, end = track.start, track.end
+        if PointDistance(start, via[0]) > radius:
+            start, end = end, start
+        vecT = NormalizeVector((end[0] - start[0], end[1] - start[1]))
+        exit, backoff = FindViaExit(start, vecT, via, radius)
+        if track.length - backoff < via[1]*(hpercent/100.0):
+            # Short track, followed or narrowed
+            return None
+
+        # Exit point in the frame of the track, via at origin
+        dx, dy = exit[0] - via[0][0], exit[1] - via[0][1]
+        ex = dx*vecT[0] + dy*vecT[1]
+        ey = -dx*vecT[1] + dy*vecT[0]
+        key = (track.width, via[1], hpercent, vpercent, segs, tolerance,
+               bool(noBulge), bool(follow_tracks),
+               int(round(atan2(ey, ex)*180/pi / self.angle_step)),
+               int(round(sqrt(ex*ex + ey*ey) / 1000)))
+        return key, via[0], vecT
+
+    def Get(self, slot):
+        """Return the teardrop of a slot: False if no teardrop fits,
+        (outline, None) like ComputePoints, or None if it is not cached
+        yet, in which case compute it and Put it"""
+        key, (cx, cy), (cos_t, sin_t) = slot
+        if key not in self.shapes:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.shapes.move_to_end(key)
+        outline = self.shapes[key]
+        if not outline:
+            return False
+        # Rotate along the track and move to the via
+        return [(cx + x*cos_t - y*sin_t, cy + x*sin_t + y*cos_t)
+                for x, y in outline], None
+
+    def Put(self, slot, coor, segs, tolerance=0):
+        """Store the points ComputePoints gave for a slot, return them like
+        Get does"""
+        key, (cx, cy), (cos_t, sin_t) = slot
+        if not coor:
+            self.__Put(key, False)
+            return False
+        outline = BuildOutlines([coor], segs, tolerance)[0]
+        self.__Put(key, [((x - cx)*cos_t + (y - cy)*sin_t,
+                          -(x - cx)*sin_t + (y - cy)*cos_t)
+                         for x, y in outline])
+        return outline, None
+
+
+def BuildTrackLookup(tracks):
+    """Map the Track records of the table by layer, net and endpoint cell"""
+    trackLookup = {}
+    for row in range(len(tracks)):
+        t = tracks.Record(row)
+        for p in (t.start, t.end):
+            key = (t.layer, t.net,
+                   p[0] // ENDPOINT_GRID, p[1] // ENDPOINT_GRID)
+            if key not in trackLookup:
+                trackLookup[key] = [t]
+            elif trackLookup[key][-1] is not t:
+                trackLookup[key].append(t)
+    return trackLookup
+
+
+def FindTouchingTrack(t1, endpoint, trackLookup):
+    """Find a track connected to the end of another track"""
+    match = 0
+    matches = 0
+    ret = False, False
+    cx = endpoint[0] // ENDPOINT_GRID
+    cy = endpoint[1] // ENDPOINT_GRID
+    near = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            near.extend(trackLookup.get((t1.layer, t1.net, cx+dx, cy+dy), ()))
+    for i, t2 in enumerate(near):
+        # Both ends of a track can be in the cells around the endpoint
+        if t2 in near[:i]:
+            continue
+        # The track object can change, this seems like the only
+        # reliable way to test if tracks are the same
+        if t2.start == t1.start and t2.end == t1.end:
+            continue
+        match = IsPointOnEnds(t2, endpoint, 10)
+        if match:
+            # if faced with a Y junction, stop here
+            matches += 1
+            if matches > 1:
+                return False, False
+            ret = match, t2
+    return ret
+
+
+def FindPositionAndVectorAlongArc(track, pos, trackReversed):
+    """ return the x,y position and direction vector at a point on an arc """
+    radius     = track.radius
+    length     = track.length
+    arcCenter  = track.center
+
+    # startAngle, endAngle are the absolute start and end.
+    # angle is the included angle of the arc, negative if anticlockwise
+    if trackReversed:
+        angle      = -track.angle
+        startAngle = track.end_angle
+    else:
+        angle      = track.angle
+        startAngle = track.start_angle
+
+
+    posAngle = startAngle + angle * pos/length
+
+    # angle is in units of TenthsOfADegree
+    posAngle *= pi/1800
+    pcos = cos(posAngle)
+    psin = sin(posAngle)
+
+    newX = arcCenter[0] + pcos * radius
+    newY = arcCenter[1] + psin * radius
+
+    # the vector points from start towards end
+    # posAngle points from centre to pos, so rotate by 90 degrees
+    if angle > 0:
+        vec = [ -psin, pcos ]
+    else:
+        vec = [ psin, -pcos ]
+
+    return ((int(newX), int(newY)), vec)
+
+
+def FindViaExit(start, vecT, via, radius, bdelta=BACKOFF_STEP):
+    """Return the first point along the track vector, by steps of bdelta and
+    below radius, that lies outside of the via, and its distance to start.
+
+    The crossing is solved analytically (ray/circle intersection); only the
+    steps around it are checked, so the result is exactly the one of a
+    walk from start by bdelta increments.
+    """
+    def point(k):
+        backoff = k*bdelta
+        return (int(vecT[0]*backoff) + start[0],
+                int(vecT[1]*backoff) + start[1])
+
+    # Last step allowed: backoff must stay below radius
+    last = int(ceil(radius / bdelta)) - 1
+    while (last + 1) * bdelta < radius:
+        last += 1
+    while last > 0 and last * bdelta >= radius:
+        last -= 1
+
+    # |d + s.vecT| = radius, d being start relative to the via center
+    dx, dy = start[0] - via[0][0], start[1] - via[0][1]
+    b = dx*vecT[0] + dy*vecT[1]
+    c = dx*dx + dy*dy - radius*radius
+    if c >= 0:
+        first = 0
+    else:
+        first = int(ceil((-b + sqrt(b*b - c)) / bdelta))
+
+    # Integer coordinates may move the crossing by a step
+    k = max(0, first - 2)
+    while k <= last:
+        p = point(k)
+        if PointDistance(p, via[0]) >= radius:
+            return p, k*bdelta
+        k += 1
+    # Still inside the via at the last step
+    return point(last), (last + 1)*bdelta
+
+
+def ComputePoints(track, via, hpercent, vpercent, segs, follow_tracks,
+                  trackLookup, noBulge, stats=None):
+    """Compute all teardrop points.
+
+    Return False if no teardrop fits, else the 5 corner points and the
+    control points of the curves (None for straight teardrops).
+    The hops along the tracks are counted in stats, if given.
+    """
+    start = track.start
+    end = track.end
+    radius = via[1]/2.0
+    w = track.width/2
+    trackReversed = False
+
+    if vpercent > 100:
+        vpercent = 100
+
+    # ensure that start is at the via/pad end
+    if PointDistance(start, via[0]) > radius:
+        start, end = end, start
+        trackReversed = True
+
+    # get normalized track vector
+    # it will be used a base vector pointing in the track direction
+    if track.is_arc:
+        arcP, vecT = FindPositionAndVectorAlongArc(track, radius/2, trackReversed)
+    else:
+        vecT = NormalizeVector((end[0] - start[0], end[1] - start[1]))
+
+    # Find point of intersection between track and edge of via
+    # This normalizes teardrop lengths
+    start, backoff = FindViaExit(start, vecT, via, radius)
+
+    # vec now points from via to intersect point
+    vec = NormalizeVector((start[0] - via[0][0], start[1] - via[0][1]))
+
+    # choose a teardrop length
+    targetLength = via[1]*(hpercent/100.0)
+    n = min(targetLength, track.length - backoff)
+    consumed = 0
+
+    if follow_tracks:
+        # if not long enough, attempt to walk back along the curved track
+        while n+consumed < targetLength:
+            match, t = FindTouchingTrack(track, end, trackLookup)
+            if stats is not None:
+                stats.Count("hops")
+            if (match is False):
+                break
+
+            backoff = 0
+            consumed += n
+            n = min(targetLength-consumed, t.length)
+            track = t
+            end = t.end
+            start = t.start
+            if match != STARTPOINT:
+                start, end = end, start
+                trackReversed = True
+            else:
+                trackReversed = False
+
+        # Track may now not point directly at via
+        vecT = NormalizeVector((end[0] - start[0], end[1] - start[1]))
+
+    # if shortened, shrink width too
+    if n+consumed < targetLength:
+        minVpercent = 100 * float(w) / float(radius)
+        vpercent = vpercent*n/targetLength + minVpercent*(1-n/targetLength)
+
+    # find point on the track, sharp end of the teardrop
+    if track.is_arc:
+        start, vecT = FindPositionAndVectorAlongArc(track, n + consumed + backoff, trackReversed)
+        pointB = (int(start[0] + vecT[1]*w), int(start[1] - vecT[0]*w))
+        pointA = (int(start[0] - vecT[1]*w), int(start[1] + vecT[0]*w))
+    else:
+        pointB = (int(start[0] + vecT[0]*n + vecT[1]*w), int(start[1] + vecT[1]*n - vecT[0]*w))
+        pointA = (int(start[0] + vecT[0]*n - vecT[1]*w), int(start[1] + vecT[1]*n + vecT[0]*w))
+
+    # In some cases of very short, eccentric tracks the points can end up
+    # inside the teardrop. If this happens just cancel adding it
+    if (PointDistance(pointA, via[0]) < radius or
+       PointDistance(pointB, via[0]) < radius):
+        return False
+
+    # via side points
+
+    # angular positions of where the teardrop meets the via
+    dC = asin(vpercent/100.0)
+    dE = -dC
+
+    if noBulge:
+        # find (signed) angle between track and teardrop
+        offAngle = atan2(vecT[1], vecT[0]) - atan2(vec[1], vec[0])
+        if offAngle > pi:
+            offAngle -= 2*pi
+        if offAngle < -pi:
+            offAngle += 2*pi
+
+        if offAngle+dC > pi/2:
+            dC = pi/2 - offAngle
+
+        if offAngle+dE < -pi/2:
+            dE = -pi/2 - offAngle
+
+    vecC = [vec[0]*cos(dC)+vec[1]*sin(dC), -vec[0]*sin(dC)+vec[1]*cos(dC)]
+    vecE = [vec[0]*cos(dE)+vec[1]*sin(dE), -vec[0]*sin(dE)+vec[1]*cos(dE)]
+
+    pointC = (via[0][0] + int(vecC[0] * radius), via[0][1] + int(vecC[1] * radius))
+    pointE = (via[0][0] + int(vecE[0] * radius), via[0][1] + int(vecE[1] * radius))
+
+    # Introduce a last point in order to cover the via centre.
+    # If not, the zone won't be filled
+    pointD = (via[0][0] + int(vec[0]*-0.5*radius), via[0][1] + int(vec[1]*-0.5*radius))
+
+    pts = [pointA, pointB, pointC, pointD, pointE]
+    curves = None
+    if segs > 2:
+        curves = ComputeCurved(vpercent, w, vecT, via, pts)
+
+    return pts, curves
+
+
+def FollowReach(via, hpercent):
+    """Distance from the via/pad center beyond which no track end can
+    change its teardrop.
+
+    Walking along the tracks stops after the teardrop length plus the
+    part of the first track inside the via. Tracks at a Y junction end
+    within 10 nm of a walked track end.
+    """
+    radius = via[1]/2.0
+    return int(3*radius + via[1]*(hpercent/100.0) + 2*BACKOFF_STEP) + 11
+
+
+def BuildEndpointIndex(tracks, cell):
+    """Grid of the track rows by layer, net and cell of each end"""
+    index = {}
+    for row in range(len(tracks)):
+        layer, net = tracks.layer[row], tracks.net[row]
+        keys = set([(layer, net, tracks.x0[row] // cell, tracks.y0[row] // cell),
+                    (layer, net, tracks.x1[row] // cell, tracks.y1[row] // cell)])
+        for key in keys:
+            if key not in index:
+                index[key] = []
+            index[key].append(row)
+    return cell, index
+
+
+def BuildViaIndex(vias):
+    """Build a uniform grid over the via/pad centres.
+
+    Each via is registered in every cell covered by its bounding square, so
+    a track end only has to look into the single cell it falls in.
+    """
+    if len(vias) == 0:
+        return 1, {}
+    # Cell size close to the average via size keeps buckets small
+    cell = max(1, int(sum(v[1] for v in vias) / len(vias)))
+    grid = {}
+    for i, via in enumerate(vias):
+        # IsPointOnEnds rounds the distance, hence the extra unit
+        r = int(via[1]/2) + 1
+        x, y = via[0]
+        for cx in range((x - r) // cell, (x + r) // cell + 1):
+            for cy in range((y - r) // cell, (y + r) // cell + 1):
+                if (cx, cy) not in grid:
+                    grid[(cx, cy)] = []
+                grid[(cx, cy)].append(i)
+    return cell, grid
+
+
+def ViasOnTrackEnds(tracks, row, vias, via_index):
+    """Return the vias (in list order) having one of the track ends inside"""
+    cell, grid = via_index
+    candidates = set(grid.get((tracks.x0[row] // cell, tracks.y0[row] // cell), ()))
+    candidates.update(grid.get((tracks.x1[row] // cell, tracks.y1[row] // cell), ()))
+    if len(candidates) == 0:
+        return []
+    track = tracks.Record(row)
+    return [vias[i] for i in sorted(candidates)
+            if IsPointOnEnds(track, vias[i][0], int(vias[i][1]/2))]
+
+
+def MatchCandidates(tracks, vias, via_index, vpercent, existing, stats=None,
+                    progress=None):
+    """Return the (track row, via) pairs that may get a teardrop.
+
+    The pairs are a track ending in a via of the list, which runs the
+    cheap checks first: same layer, track narrower than the teardrop, only
+    one end in the via. existing(track, via) goes last and tells whether a
+    teardrop is already there. progress, if given, is called with the
+    number of tracks done and to do.
+    """
+
+    def Pairs():
+        for row in range(len(tracks)):
+            if progress is not None and row % PROGRESS_STEP == 0:
+                progress(row, len(tracks))
+            if tracks.kind[row] == VIA:
+                # Both ends of a via are inside it, it never gets a teardrop
+                continue
+            track = tracks.Record(row)
+            for via in ViasOnTrackEnds(tracks, row, vias, via_index):
+                yield track, via
+
+    def OnLayer(pair):
+        # Pad and track on different layers, or pad without copper at all
+        # (paste pads)
+        track, via = pair
+        return via[3] == -1 or via[3] == track.layer
+
+    def Narrower(pair):
+        track, via = pair
+        return track.width < via[1] * vpercent / 100
+
+    def OneEnd(pair):
+        # Track with both start and end within the via
+        track, via = pair
+        return IsPointOnEnds(track, via[0], int(via[1]/2)) != \
+            STARTPOINT | ENDPOINT
+
+    def New(pair):
+        return not existing(*pair)
+
+    # Cheapest first, the hit tests of New only run on the pairs left
+    return [(track.row, via) for track, via in Pipeline(
+        Pairs(), [("discarded_other_layer", OnLayer),
+                  ("discarded_too_wide", Narrower),
+                  ("discarded_both_ends", OneEnd),
+                  ("discarded_existing", New)],
+        stats, "pairs")]
+
+
+def BuildTeardropIndex(zones, vias, via_index, margin, legacy_only=False):
+    """Index the teardrop zones by (layer, netname, via position).
+
+    A teardrop is registered, with the center of its bounding box grown by
+    margin, for every via of the list in that box. Only the tables are read
+    here, HasTeardrop runs the hit tests for the pairs asking for them.
+    With legacy_only, teardrops with a fingerprint are left out.
+    """
+    cell, grid = via_index
+    if len(grid) == 0:
+        # No via, and the cells would be 1 nm wide
+        return {}
+    teardrop_index = {}
+    for row in range(len(zones)):
+        if zones.priority[row] != MAGIC_TEARDROP_ZONE_ID:
+            continue
+        if legacy_only and FingerprintPosition(zones.names[row]) is not None:
+            continue
+        left, top, right, bottom = zones.Rect(row)
+        left, top = left - margin, top - margin
+        right, bottom = right + margin, bottom + margin
+        center = ((left + right) // 2, (top + bottom) // 2)
+        candidates = set()
+        for cx in range(left // cell, right // cell + 1):
+            for cy in range(top // cell, bottom // cell + 1):
+                candidates.update(grid.get((cx, cy), ()))
+        positions = set(vias[i][0] for i in candidates
+                        if left <= vias[i][0][0] <= right and
+                        top <= vias[i][0][1] <= bottom)
+        for pos in positions:
+            for layer in zones.layers[row]:
+                key = (layer, zones.nets[row], pos)
+                if key not in teardrop_index:
+                    teardrop_index[key] = []
+                teardrop_index[key].append((zones.items[row], center))
+    return teardrop_index
+
+
+def HasTeardrop(teardrop_index, track, via, hit):
+    """Return True if a teardrop already covers given track AND via.
+
+    hit(zone item, track, via, center) runs the hit tests: the via on the
+    teardrop and the center of the teardrop on the track.
+    """
+    key = (track.layer, track.net, via[0])
+    # Several tracks can leave the same via, find the one of the teardrop
+    for teardrop, center in teardrop_index.get(key, ()):
+        if hit(teardrop, track, via, center):
+            return True
+    return False
+
+
+def BuildZoneIndex(zones):
+    """Group the rows of the non teardrop zones by (layer, netname)"""
+    zone_index = {}
+    for row in range(len(zones)):
+        # Exclude other Teardrops to speed up the process
+        if zones.priority[row] == MAGIC_TEARDROP_ZONE_ID:
+            continue
+        for layer in zones.layers[row]:
+            key = (layer, zones.nets[row])
+            if key not in zone_index:
+                zone_index[key] = []
+            zone_index[key].append(row)
+    return zone_index
+
+
+def InSameNetZone(zones, zone_index, via, track, contains):
+    """Return True if the via is inside a zone of the net and layer of the
+    track. contains(zone item, point) runs the polygon test"""
+    x, y = via[0]
+    for row in zone_index.get((track.layer, track.net), ()):
+        left, top, right, bottom = zones.Rect(row)
+        # Only run the polygon test when the bounding box matches
+        if left <= x <= right and top <= y <= bottom and \
+           contains(zones.items[row], via[0]):
+            return True
+    return False
+
+
+def DiscardInSameZone(tracks, zones, items, contains, stats=None):
+    """Return the items whose via is not inside a zone of the net and layer
+    of their track, see InSameNetZone. Each item starts with its (track
+    row, via) candidate"""
+    zone_index = BuildZoneIndex(zones)
+
+    def OutOfZone(item):
+        row, via = item[0]
+        return not InSameNetZone(zones, zone_index, via, tracks.Record(row),
+                                 contains)
+
+    return list(Pipeline(items, [("discarded_same_zone", OutOfZone)], stats))
+
+
+def FitTeardrops(tracks, zones, candidates, hpercent, vpercent, segs,
+                 follow_tracks, noBulge, workers=1, stats=None,
+                 shape_cache=None, tolerance=0, contains=None, progress=None):
+    """Compute the teardrops of the candidates, as ComputeTeardrops does,
+    and return the (candidate index, points) of the ones to add.
+
+    The teardrops that do not fit are dropped, and with contains the ones
+    whose via is in a zone of their net (see DiscardInSameZone). The
+    polygon tests go last, on the teardrops that fit only.
+    """
+    start = time.time()
+    results = ComputeTeardrops(tracks, candidates, hpercent, vpercent, segs,
+                               follow_tracks, noBulge, workers, stats,
+                               shape_cache, tolerance, progress)
+    computed = [(candidate, i, coor) for i, (candidate, coor)
+                in enumerate(zip(candidates, results)) if coor]
+    if stats is not None:
+        start = stats.Lap("geometry", start)
+        stats.Count("discarded_no_fit", len(candidates) - len(computed))
+
+    if contains is not None:
+        computed = DiscardInSameZone(tracks, zones, computed, contains, stats)
+    if stats is not None:
+        stats.Lap("zone_check", start)
+    return [(i, coor) for _, i, coor in computed]
+
+
+def __TrackGeometry(tracks, row):
+    """Everything the teardrop computation reads from a track row"""
+    geometry = (tracks.kind[row], tracks.x0[row], tracks.y0[row],
+                tracks.x1[row], tracks.y1[row], tracks.width[row],
+                tracks.layer[row], tracks.length[row])
+    if tracks.kind[row] == ARC:
+        t = tracks.Record(row)
+        geometry += (t.center, t.radius, t.angle, t.start_angle, t.end_angle)
+    return geometry
+
+
+def Fingerprint(tracks, endpoint_index, row, via, params):
+    """Fingerprint of the inputs of the teardrop of a track row and a via.
+
+    params are (hpercent, vpercent, segs, follow_tracks, noBulge), followed
+    by the tolerance when there is one. When tracks are followed, it also
+    covers every track of the same layer and net ending within FollowReach
+    of the via.
+    """
+    hpercent, follow_tracks = params[0], params[3]
+    x, y = via[0]
+    inputs = [params, via, __TrackGeometry(tracks, row)]
+    if follow_tracks:
+        cell, index = endpoint_index
+        reach = FollowReach(via, hpercent)
+        layer, net = tracks.layer[row], tracks.net[row]
+        near = set()
+        for cx in range((x - reach) // cell, (x + reach) // cell + 1):
+            for cy in range((y - reach) // cell, (y + reach) // cell + 1):
+                near.update(index.get((layer, net, cx, cy), ()))
+        limit = reach * reach
+        inputs.append(sorted(
+            __TrackGeometry(tracks, r) for r in near
+            if (tracks.x0[r] - x)**2 + (tracks.y0[r] - y)**2 <= limit or
+               (tracks.x1[r] - x)**2 + (tracks.y1[r] - y)**2 <= limit))
+    digest = hashlib.sha1(repr(inputs).encode("ascii")).hexdigest()
+    return "{}{},{}:{}".format(FINGERPRINT_PREFIX, x, y, digest[:20])
+
+
+def FingerprintPosition(name):
+    """Return the via/pad position in a teardrop zone name, None if the
+    name holds no fingerprint"""
+    if not name.startswith(FINGERPRINT_PREFIX):
+        return None
+    try:
+        x, y = name[len(FINGERPRINT_PREFIX):].split(":")[0].split(",")
+        return int(x), int(y)
+    except ValueError:
+        return None
+
+
+__worker = {}
+
+
+def __InitWorker(tracks, params, with_stats):
+    """Set up the data shared by all the tasks of a pool worker"""
+    __worker["tracks"] = tracks
+    __worker["params"] = params
+    __worker["stats"] = with_stats
+    __worker["lookup"] = BuildTrackLookup(tracks) if params[3] else {}
+
+
+def __ComputeChunk(chunk):
+    """Compute the teardrops of a chunk of candidates in a pool worker"""
+    tracks = __worker["tracks"]
+    trackLookup = __worker["lookup"]
+    hpercent, vpercent, segs, follow_tracks, noBulge = __worker["params"]
+    stats = Stats() if __worker["stats"] else None
+    coors = [ComputePoints(tracks.Record(row), via, hpercent, vpercent, segs,
+                           follow_tracks, trackLookup, noBulge, stats)
+             for row, via in chunk]
+    return coors, stats.counters if stats is not None else {}
+
+
+def ComputeTeardrops(tracks, candidates, hpercent, vpercent, segs,
+                     follow_tracks, noBulge, workers=1, stats=None,
+                     shape_cache=None, tolerance=0, progress=None):
+    """Compute the points of all the (track row, via) candidates.
+
+    With more than one worker (None for one per CPU) and enough candidates,
+    the work is spread over a process pool. Either way the results come
+    back in the order of the candidates. The teardrops a ShapeCache given
+    as shape_cache can provide are taken from it, with their outline
+    already built for tolerance (see BuildOutlines). The shapes it lacks
+    are computed once each, along with the other candidates. progress, if
+    given, is called with the number of candidates done and to do.
+    """
+    params = (hpercent, vpercent, segs, follow_tracks, noBulge)
+    if shape_cache is None:
+        return __ComputeAll(tracks, candidates, params, workers, stats,
+                            progress)
+
+    hits, misses = shape_cache.hits, shape_cache.misses
+    results = []
+    missing = []
+    # Shapes not cached yet, computed once for all the teardrops sharing
+    # them: key -> [(candidate index, slot)], the first one is computed
+    pending = OrderedDict()
+    for i, (row, via) in enumerate(candidates):
+        slot = shape_cache.Slot(tracks.Record(row), via, hpercent, vpercent,
+                                segs, follow_tracks, noBulge, tolerance)
+        coor = None
+        if slot is None:
+            missing.append(i)
+        elif slot[0] in pending:
+            pending[slot[0]].append((i, slot))
+        else:
+            coor = shape_cache.Get(slot)
+            if coor is None:
+                pending[slot[0]] = [(i, slot)]
+        results.append(coor)
+    # Cache misses go through the worker pool with the uncached teardrops
+    shapes = list(pending.values())
+    computed = __ComputeAll(tracks, [candidates[i] for i in missing] +
+                            [candidates[same[0][0]] for same in shapes],
+                            params, workers, stats, progress)
+    for i, coor in zip(missing, computed):
+        results[i] = coor
+    for same, coor in zip(shapes, computed[len(missing):]):
+        i, slot = same[0]
+        results[i] = shape_cache.Put(slot, coor, segs, tolerance)
+        for i, slot in same[1:]:
+            results[i] = shape_cache.Get(slot)
+    if stats is not None:
+        stats.Count("shape_cache_hits", shape_cache.hits - hits)
+        stats.Count("shape_cache_misses", shape_cache.misses - misses)
+    return results
+
+
+def __ComputeAll(tracks, candidates, params, workers, stats, progress):
+    """Compute the candidates, in a process pool when worth it"""
+    hpercent, vpercent, segs, follow_tracks, noBulge = params
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(candidates) >= POOL_MIN_CANDIDATES:
+        # A few chunks per worker balances the load
+        size = -(-len(candidates) // (workers * 4))
+        chunks = [candidates[i:i+size]
+                  for i in range(0, len(candidates), size)]
+        try:
+            with ProcessPoolExecutor(workers, initializer=__InitWorker,
+                                     initargs=(tracks, params,
+                                               stats is not None)) as pool:
+                done = []
+                for result in pool.map(__ComputeChunk, chunks):
+                    done.append(result)
+                    if progress is not None:
+                        progress(min(len(done) * size, len(candidates)),
+                                 len(candidates))
+        except (OSError, NotImplementedError, BrokenProcessPool):
+            # No process support here, just go on in this process
+            done = None
+        if done is not None:
+            results = []
+            for coors, counters in done:
+                results.extend(coors)
+                if stats is not None:
+                    stats.Merge(counters)
+            return results
+
+    trackLookup = BuildTrackLookup(tracks) if follow_tracks else {}
+    if progress is None:
+        return [ComputePoints(tracks.Record(row), via, hpercent, vpercent,
+                              segs, follow_tracks, trackLookup, noBulge, stats)
+                for row, via in candidates]
+    results = []
+    for i, (row, via) in enumerate(candidates):
+        if i % PROGRESS_STEP == 0:
+            progress(i, len(candidates))
+        results.append(ComputePoints(tracks.Record(row), via, hpercent,
+                                     vpercent, segs, follow_tracks,
+                                     trackLookup, noBulge, stats))
+    progress(len(candidates), len(candidates))
+    return results
@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# Direct access to .kicad_pcb files, without pcbnew objects
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+"""Streaming access to .kicad_pcb files.
+
+ZoneWriter copies a board file and appends teardrop zones to it as text,
+instead of building a pcbnew ZONE for each of them. ReadBoard goes the
+other way: it reads the tracks, vias, pads and zones of a file straight
+into the tables of td_engine, and PreviewFile computes the teardrops from
+them, so that boards can be checked without KiCad. Coordinates are in
+internal units (nm) and written in mm, like KiCad does.
+"""
+
+import mmap
+import os
+import re
+import time
+import uuid
+from math import atan2, cos, sin, hypot, floor, pi, radians
+
+try:
+    from .td_engine import Stats, BoardData, ShapeCache, BuildViaIndex
+    from .td_engine import MatchCandidates, FitTeardrops, BuildOutlines
+    from .td_engine import BuildTeardropIndex, HasTeardrop
+    from .td_engine import MAGIC_TEARDROP_ZONE_ID
+    from .td_engine import TRACK, ARC, VIA, PAD_PTH, PAD_SMD
+except ImportError:
+    # Used on its own, td_engine.py must be next to it
+    from td_engine import Stats, BoardData, ShapeCache, BuildViaIndex
+    from td_engine import MatchCandidates, FitTeardrops, BuildOutlines
+    from td_engine import BuildTeardropIndex, HasTeardrop
+    from td_engine import MAGIC_TEARDROP_ZONE_ID
+    from td_engine import TRACK, ARC, VIA, PAD_PTH, PAD_SMD
+
+# First file format using uuid instead of tstamp (KiCad 8)
+UUID_VERSION = 20231014
+
+# Bytes read at the end of the source to find its closing parenthesis
+TAIL_SIZE = 4096
+COPY_CHUNK = 1 << 20
+
+# One token: an opening or closing parenthesis, a quoted string or an atom
+TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))',
+                   re.S)
+
+# A list without child lists, like (start 1 2): its head and the rest
+LEAF = re.compile(rb'\s*\(([^\s()"]+)((?:[^()"]|"(?:[^"\\]|\\.)*")*)\)',
+                  re.S)
+
+# The strings and atoms of such a list
+ATOMS = re.compile(rb'"((?:[^"\\]|\\.)*)"|([^\s"]+)', re.S)
+
+# A run of atoms, strings and lists without child lists, skipped at once
+SKIP = re.compile(rb'(?:[^()"]+|\([^()"]*\)|"(?:[^"\\]|\\.)*"|'
+                  rb'\((?:[^()"]|"(?:[^"\\]|\\.)*")*\))*', re.S)
+
+ESCAPE = re.compile(r'\\(.)', re.S)
+
+# Child lists kept when reading a list, the others (graphics, fills,
+# settings) are skipped unread. Lists not listed here keep all of them
+KEPT_CHILDREN = {
+    "segment": ("start", "mid", "end", "width", "layer", "net"),
+    "arc": ("start", "mid", "end", "width", "layer", "net"),
+    "via": ("at", "size", "drill", "layers", "net"),
+    "footprint": ("at", "pad"),
+    "module": ("at", "pad"),
+    "pad": ("at", "size", "layers", "net"),
+    "zone": ("net", "net_name", "layer", "layers", "name", "priority",
+             "polygon"),
+    "polygon": ("pts",),
+    "pts": ("xy",),
+}
+
+# Copper layer ids of the files without layer table (KiCad 6 numbering)
+DEFAULT_COPPER = dict([("F.Cu", 0), ("B.Cu", 31)] +
+                      [("In{}.Cu".format(i), i) for i in range(1, 31)])
+
+# Zone hit tests accept points this close to the outline, like KiCad
+HIT_ACCURACY = 100000
+
+
+def FormatMM(iu):
+    """Internal units as KiCad writes them: mm, at most 6 decimals"""
+    text = "{:.6f}".format(iu / 1e6).rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def Quote(text):
+    """Quoted s-expression string"""
+    return '"{}"'.format(text.replace("\\", "\\\\").replace('"', '\\"')
+                         .replace("\n", "\\n"))
+
+
+def FileVersion(path):
+    """Return the format version in the header of a .kicad_pcb file"""
+    with open(path, "rb") as f:
+        header = f.read(256)
+    match = re.search(br"\(version\s+(\d+)\)", header)
+    if not header.lstrip().startswith(b"(kicad_pcb") or match is None:
+        raise ValueError("{} is not a .kicad_pcb file".format(path))
+    return int(match.group(1))
+
+
+class ZoneWriter(object):
+    """Copy of a .kicad_pcb file, with zones appended as they are added.
+
+    Everything up to the closing parenthesis of the source is copied when
+    the writer is created, then each AddZone writes one zone. The copy is
+    written next to output and only replaces it on Close, so output may be
+    the source itself. Without filled, the zones are written unfilled, for
+    a copy no one fills afterwards.
+    """
+
+    def __init__(self, source, output, filled=True):
+        self.output = output
+        self.partial = output + ".part"
+        self.filled = filled
+        self.count = 0
+        version = FileVersion(source)
+        self.uuid_token = "uuid" if version >= UUID_VERSION else "tstamp"
+
+        with open(source, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - TAIL_SIZE))
+            tail = f.read()
+            end = tail.rfind(b")")
+            if end < 0:
+                raise ValueError("{} is not a .kicad_pcb file".format(source))
+            left = size - len(tail) + end
+            f.seek(0)
+            self.file = open(self.partial, "wb")
+            try:
+                chunk = b""
+                while left > 0:
+                    chunk = f.read(min(COPY_CHUNK, left))
+                    self.file.write(chunk)
+                    left -= len(chunk)
+                if not chunk.endswith(b"\n"):
+                    self.file.write(b"\n")
+            except Exception:
+                # No half copy left next to output
+                self.Abort()
+                raise
+
+    def AddZone(self, net, net_name, layer, points, name, clearance,
+                priority, min_thickness):
+        """Write a polygon mode zone with full pad connection and no corner
+        smoothing, like the ones built through pcbnew"""
+        pts = []
+        for i in range(0, len(points), 4):
+            pts.append("        " + " ".join(
+                "(xy {} {})".format(FormatMM(int(p[0])), FormatMM(int(p[1])))
+                for p in points[i:i+4]))
+        text = (
+            "  (zone (net {net}) (net_name {net_name}) (layer {layer}) "
+            "({token} {uuid}) (name {name}) (hatch edge 0.508)\n"
+            "    (priority {priority})\n"
+            "    (connect_pads yes (clearance {clearance}))\n"
+            "    (min_thickness {min_thickness}) (filled_areas_thickness no)\n"
+            "    (fill{filled} (thermal_gap 0.508) "
+            "(thermal_bridge_width 0.508))\n"
+            "    (polygon\n"
+            "      (pts\n"
+            "{pts}\n"
+            "      )\n"
+            "    )\n"
+            "  )\n").format(
+                net=net, net_name=Quote(net_name), layer=Quote(layer),
+                token=self.uuid_token, uuid=uuid.uuid4(), name=Quote(name),
+                filled=" yes" if self.filled else "",
+                priority=priority, clearance=FormatMM(clearance),
+                min_thickness=FormatMM(min_thickness), pts="\n".join(pts))
+        self.file.write(text.encode("utf-8"))
+        self.count += 1
+
+    def Close(self):
+        """Finish the file and move it to the output path"""
+        self.file.write(b")\n")
+        self.file.close()
+        os.replace(self.partial, self.output)
+
+    def Abort(self):
+        """Drop the copy, leaving output as it was"""
+        self.file.close()
+        os.remove(self.partial)
+
+
+def __Round(value):
+    """Round half away from zero, like KiROUND"""
+    return int(floor(value + 0.5)) if value >= 0 else -int(floor(-value + 0.5))
+
+
+def __IU(text):
+    """Length of the file (mm) in internal units, rounded like KiCad"""
+    return __Round(float(text) * 1e6)
+
+
+def __Unescape(match):
+    """Character of an escape sequence"""
+    char = match.group(1)
+    return "\n" if char == "n" else char
+
+
+def __Text(quoted, atom):
+    """Text of a string (quoted) or atom token, the other one being None
+    or empty"""
+    if quoted:
+        text = quoted.decode("utf-8")
+        return ESCAPE.sub(__Unescape, text) if "\\" in text else text
+    return atom.decode("utf-8") if atom is not None else ""
+
+
+def __Head(data, pos):
+    """Read the head of the list opened just before pos, return it and the
+    position after it"""
+    match = TOKEN.match(data, pos)
+    if match is None or match.lastindex < 3:
+        raise ValueError("list without head at byte {}".format(pos))
+    return __Text(match.group(3), match.group(4)), match.end()
+
+
+def __SkipList(data, pos):
+    """Return the position after the end of the list holding pos"""
+    depth = 1
+    while True:
+        pos = SKIP.match(data, pos).end()
+        char = data[pos:pos+1]
+        if char == b"(":
+            depth += 1
+        elif char == b")":
+            depth -= 1
+            if depth == 0:
+                return pos + 1
+        else:
+            raise ValueError("unexpected end of file")
+        pos += 1
+
+
+def __ReadList(data, pos, head):
+    """Read the rest of a list up to its closing parenthesis.
+
+    Return the [head, children...] node and the position after it, atoms
+    being strings and lists nodes. Only the children listed in
+    KEPT_CHILDREN for head are read, the other lists are skipped.
+    """
+    kept = KEPT_CHILDREN.get(head)
+    node = [head]
+    while True:
+        # Most lists hold atoms only, read them at once
+        leaf = LEAF.match(data, pos)
+        if leaf is not None:
+            pos = leaf.end()
+            child = leaf.group(1).decode("utf-8")
+            if kept is None or child in kept:
+                node.append([child] + [__Text(quoted, atom) for quoted, atom
+                                       in ATOMS.findall(leaf.group(2))])
+            continue
+        match = TOKEN.match(data, pos)
+        if match is None:
+            raise ValueError("unexpected end of file")
+        pos = match.end()
+        token = match.lastindex
+        if token == 2:
+            return node, pos
+        if token != 1:
+            node.append(__Text(match.group(3), match.group(4)))
+            continue
+        child, pos = __Head(data, pos)
+        if kept is None or child in kept:
+            child, pos = __ReadList(data, pos, child)
+            node.append(child)
+        else:
+            pos = __SkipList(data, pos)
+
+
+def __Child(node, head):
+    """First child list of the node with the given head, None if none"""
+    for child in node:
+        if type(child) is list and child[0] == head:
+            return child
+    return None
+
+
+def __ArcGeometry(start, mid, end):
+    """Center, radius, angle, start and end angles (tenths of degree) and
+    length of the arc through the three points, like pcbnew gives them.
+    None if the points are in line"""
+    (ax, ay), (bx, by), (cx, cy) = start, mid, end
+    d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if d == 0:
+        return None
+    ux = ((ax * ax + ay * ay) * (by - cy) + (bx * bx + by * by) * (cy - ay)
+          + (cx * cx + cy * cy) * (ay - by)) / d
+    uy = ((ax * ax + ay * ay) * (cx - bx) + (bx * bx + by * by) * (ax - cx)
+          + (cx * cx + cy * cy) * (bx - ax)) / d
+    center = (__Round(ux), __Round(uy))
+    radius = __Round(hypot(ax - center[0], ay - center[1]))
+
+    def Angle(p):
+        return atan2(p[1] - center[1], p[0] - center[0]) * 180.0 / pi
+
+    def Normalize(deg):
+        while deg < 0:
+            deg += 360.0
+        while deg >= 360.0:
+            deg -= 360.0
+        return deg
+
+    def Normalize180(deg):
+        while deg <= -180.0:
+            deg += 360.0
+        while deg > 180.0:
+            deg -= 360.0
+        return deg
+
+    angle = Normalize180(Angle(mid) - Angle(start)) + \
+        Normalize180(Angle(end) - Angle(mid))
+    length = radius * abs(angle) * pi / 180
+    return (center, radius, angle * 10.0, Normalize(Angle(start)) * 10.0,
+            Normalize(Angle(end)) * 10.0, length)
+
+
+def ReadBoard(path):
+    """Read the tracks, vias, pads and zones of a .kicad_pcb file into a
+    BoardData, without pcbnew.
+
+    The file is mapped in memory and read in a single pass. Only the lists
+    the teardrops need are parsed: footprint graphics, zone fills and the
+    like are skipped unread. Rows keep no board object. The item of a zone
+    row is the list of its polygons: as KiCad reads them, the first one is
+    the outline and the next ones are holes.
+    """
+    FileVersion(path)
+    board = BoardData()
+    tracks = board.tracks
+    copper = dict(DEFAULT_COPPER)
+    nets = {}
+    pads = []
+
+    def CuStack(names):
+        """Copper layer ids of the layer names, front to back"""
+        ids = set()
+        for name in names:
+            if name == "*.Cu":
+                ids.update(copper.values())
+            elif name == "F&B.Cu":
+                ids.update(copper[n] for n in ("F.Cu", "B.Cu") if n in copper)
+            elif name in copper:
+                ids.add(copper[name])
+        back = copper.get("B.Cu")
+        return sorted(ids, key=lambda i: (i == back, i))
+
+    def Point(node, head):
+        child = __Child(node, head)
+        return __IU(child[1]), __IU(child[2])
+
+    def Value(node, head, default=None):
+        child = __Child(node, head)
+        return child[1] if child is not None and len(child) > 1 else default
+
+    def Net(node):
+        child = __Child(node, "net")
+        if child is None or len(child) < 2:
+            return ""
+        if len(child) > 2:
+            return child[2]
+        return nets.get(child[1], child[1])
+
+    def Layers(node):
+        # The table of the file replaces the default copper layers
+        copper.clear()
+        for child in node[1:]:
+            # (<id> <name> <type> [<user name>])
+            if type(child) is list and len(child) > 1 and \
+               child[1].endswith(".Cu"):
+                copper[child[1]] = int(child[0])
+
+    def NetTable(node):
+        if len(node) > 2:
+            nets[node[1]] = node[2]
+
+    def Track(node):
+        layer = copper.get(Value(node, "layer"))
+        if layer is None:
+            return
+        start, end = Point(node, "start"), Point(node, "end")
+        arc = None
+        if node[0] == "arc":
+            arc = __ArcGeometry(start, Point(node, "mid"), end)
+        if arc is None:
+            row = tracks.Append(TRACK, start, end, __IU(Value(node, "width")),
+                                layer, Net(node),
+                                hypot(end[0] - start[0], end[1] - start[1]))
+        else:
+            row = tracks.Append(ARC, start, end, __IU(Value(node, "width")),
+                                layer, Net(node), arc[5])
+            tracks.SetArc(row, *arc[:5])
+
+    def Via(node):
+        pos = Point(node, "at")
+        size = __IU(Value(node, "size"))
+        layers = __Child(node, "layers")
+        stack = CuStack(layers[1:]) if layers is not None else []
+        board.vias.Append(VIA, pos, size, __IU(Value(node, "drill", "0")), -1,
+                          False)
+        # Vias are tracks too, on their first layer, as pcbnew lists them
+        tracks.Append(VIA, pos, pos, size, stack[0] if stack else 0,
+                      Net(node), 0.0)
+
+    def Footprint(node):
+        at = __Child(node, "at")
+        x, y = __IU(at[1]), __IU(at[2])
+        angle = radians(float(at[3])) if len(at) > 3 else 0
+        for pad in node[1:]:
+            if type(pad) is list and pad[0] == "pad" and len(pad) > 2:
+                Pad(pad, x, y, angle)
+
+    def Pad(node, x, y, angle):
+        if node[2] == "thru_hole":
+            kind, layer = PAD_PTH, -1
+        elif node[2] == "smd":
+            kind = PAD_SMD
+            layers = __Child(node, "layers")
+            stack = CuStack(layers[1:]) if layers is not None else []
+            if len(stack) == 0:
+                # The pad is not on a Copper layer
+                return
+            layer = stack[0]
+        else:
+            return
+        at = __Child(node, "at")
+        px, py = __IU(at[1]), __IU(at[2])
+        if angle:
+            # Pad positions are relative to the footprint, rotated like
+            # RotatePoint does
+            px, py = (__Round(py * sin(angle) + px * cos(angle)),
+                      __Round(py * cos(angle) - px * sin(angle)))
+        size = __Child(node, "size")
+        pads.append((kind, (x + px, y + py),
+                     min(__IU(size[1]), __IU(size[2])), layer))
+
+    def Zone(node):
+        polygons = []
+        for child in node[1:]:
+            if type(child) is list and child[0] == "polygon":
+                pts = __Child(child, "pts")
+                polygons.append([(__IU(xy[1]), __IU(xy[2])) for xy in pts[1:]
+                                 if type(xy) is list and xy[0] == "xy"])
+        polygons = [points for points in polygons if points]
+        layers = __Child(node, "layers") or __Child(node, "layer")
+        if len(polygons) == 0 or layers is None:
+            return
+        priority = int(Value(node, "priority", "0"))
+        name = Value(node, "name", "")
+        net = Value(node, "net_name")
+        if net is None:
+            net = Net(node)
+        stack = CuStack(layers[1:])
+        # The holes are inside the outline, which gives the bounding box
+        xs = [p[0] for p in polygons[0]]
+        ys = [p[1] for p in polygons[0]]
+        board.zones.Append(priority, net, stack,
+                           (min(xs), min(ys), max(xs), max(ys)), polygons,
+                           name)
+
+    handlers = {"layers": Layers, "net": NetTable, "segment": Track,
+                "arc": Track, "via": Via, "footprint": Footprint,
+                "module": Footprint, "zone": Zone}
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = data.find(b"kicad_pcb") + len(b"kicad_pcb")
+            while True:
+                match = TOKEN.match(data, pos)
+                if match is None:
+                    raise ValueError("unexpected end of file")
+                pos = match.end()
+                if match.lastindex == 2:
+                    break
+                if match.lastindex != 1:
+                    continue
+                head, pos = __Head(data, pos)
+                if head in handlers:
+                    node, pos = __ReadList(data, pos, head)
+                    handlers[head](node)
+                else:
+                    pos = __SkipList(data, pos)
+        finally:
+            data.close()
+    # pcbnew lists the pads after the vias, whatever the file order
+    for kind, pos, size, layer in pads:
+        board.vias.Append(kind, pos, size, 0, layer, False)
+    return board
+
+
+def __SegmentDistance(p, a, b):
+    """Distance from the point to the segment"""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    ll = dx * dx + dy * dy
+    if ll == 0:
+        return hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) /
+                     float(ll)))
+    return hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+def __InPolygon(p, points):
+    """Return True if the point is inside the polygon"""
+    x, y = p
+    inside = False
+    for i in range(len(points)):
+        x0, y0 = points[i - 1]
+        x1, y1 = points[i]
+        if (y0 > y) != (y1 > y) and \
+           x < x0 + (y - y0) * (x1 - x0) / float(y1 - y0):
+            inside = not inside
+    return inside
+
+
+def __OnOutline(p, polygons):
+    """Zone hit test of pcbnew: the point is close to a corner or an edge"""
+    for points in polygons:
+        for i in range(len(points)):
+            if hypot(p[0] - points[i][0], p[1] - points[i][1]) <= \
+                    2 * HIT_ACCURACY or \
+               __SegmentDistance(p, points[i - 1], points[i]) <= HIT_ACCURACY:
+                return True
+    return False
+
+
+def __OnTrack(track, p):
+    """Track hit test of pcbnew: the point is on the copper of the track"""
+    if not track.is_arc:
+        return __SegmentDistance(p, track.start, track.end) <= track.width / 2
+    # Round ends first, like pcbnew
+    width = track.width / 2
+    if hypot(p[0] - track.start[0], p[1] - track.start[1]) <= width or \
+       hypot(p[0] - track.end[0], p[1] - track.end[1]) <= width:
+        return True
+    cx, cy = track.center
+    if abs(hypot(p[0] - cx, p[1] - cy) - track.radius) > width:
+        return False
+    # Angle from the start of the arc, in tenths of degree
+    angle = atan2(p[1] - cy, p[0] - cx) * 1800 / pi - track.start_angle
+    angle %= 3600
+    if track.angle < 0:
+        return angle >= 3600 + track.angle
+    return angle <= track.angle
+
+
+def __HitTeardrop(polygons, track, via, center):
+    """Hit tests of pcbnew on a teardrop of the file, see HasTeardrop"""
+    return __OnOutline(via[0], polygons) and __OnTrack(track, center)
+
+
+def __ZoneContains(polygons, point):
+    """Polygon test of a zone of the file: in its outline and out of its
+    holes"""
+    return __InPolygon(point, polygons[0]) and \
+        not any(__InPolygon(point, hole) for hole in polygons[1:])
+
+
+def PreviewFile(path, hpercent=50, vpercent=90, segs=10, use_smd=False,
+                discard_in_same_zone=True, follow_tracks=True, noBulge=True,
+                workers=1, shape_cache=None, tolerance=0, region=None):
+    """Compute the teardrops SetTeardrops would add to a .kicad_pcb file,
+    reading it with ReadBoard: neither KiCad nor pcbnew objects are needed.
+
+    The options are the ones of SetTeardrops: shape_cache=True uses the
+    shapes saved next to the file. A file has no selection, so all the
+    vias/pads are processed, or the ones centered in region. Existing
+    teardrops are found with the rules of td.py, on the outlines of the
+    file. Return a Stats object like PreviewTeardrops does.
+    """
+    cache_path = None
+    if shape_cache is True:
+        shape_cache = ShapeCache()
+        cache_path = os.path.splitext(path)[0] + "-teardrops-cache.json"
+        shape_cache.Load(cache_path)
+    stats = Stats()
+    start = time.time()
+    board = ReadBoard(path)
+    tracks = board.tracks
+    kinds = [VIA, PAD_PTH] + [PAD_SMD]*use_smd
+    vias = [board.vias.Via(row)
+            for row in board.vias.Rows(kinds, region=region)]
+    start = stats.Lap("read", start)
+
+    via_index = BuildViaIndex(vias)
+    teardrop_index = BuildTeardropIndex(board.zones, vias, via_index,
+                                        2 * HIT_ACCURACY)
+
+    def Existing(track, via):
+        return HasTeardrop(teardrop_index, track, via, __HitTeardrop)
+
+    candidates = MatchCandidates(tracks, vias, via_index, vpercent, Existing,
+                                 stats)
+    start = stats.Lap("match", start)
+    stats.Count("hops", 0)
+
+    contains = __ZoneContains if discard_in_same_zone else None
+    computed = [(candidates[i], coor) for i, coor
+                in FitTeardrops(tracks, board.zones, candidates, hpercent,
+                                vpercent, segs, follow_tracks, noBulge,
+                                workers, stats, shape_cache, tolerance,
+                                contains)]
+    start = time.time()
+    outlines = BuildOutlines([coor for _, coor in computed], segs, tolerance)
+    stats.outlines = [(tracks.layer[row], tracks.nets[tracks.net[row]],
+                       outline)
+                      for ((row, via), _), outline in zip(computed, outlines)]
+    stats.count = len(stats.outlines)
+    stats.Lap("geometry", start)
+    stats.Count("teardrops", stats.count)
+    stats.Count("outline_points", sum(len(o) for o in outlines))
+    if cache_path is not None:
+        shape_cache.Save(cache_path)
+    return stats
@@ -0,0 +1,754 @@
+#!/usr/bin/env python
+
+# Teardrop for pcbnew using filled zones
+# Minimal pure Python stand-in for the pcbnew classes used by td.py
+# (c) Niluje 2019 thewireddoesntexist.org
+#
+# Based on Teardrops for PCBNEW by svofski, 2014 http://sensi.org/~svo
+# Cubic Bezier upgrade by mitxela, 2021 mitxela.com
+
+"""Headless stand-in for the subset of pcbnew used by the teardrop scripts.
+
+Only meant for benchmarks and equivalence checks when KiCad is not
+installed. The semantics follow the KiCad sources closely enough for the
+teardrop algorithm (IsPointOnEnds, HitTest, polygon Contains, arcs).
+"""
+
+import sys
+from math import atan2, floor, hypot, pi
+
+IU_PER_MM = 1e6
+
+# Item flags
+STARTPOINT = 1 << 9
+ENDPOINT = 1 << 10
+
+# Pad attributes
+PAD_ATTRIB_PTH = 0
+PAD_ATTRIB_SMD = 1
+PAD_ATTRIB_CONN = 2
+PAD_ATTRIB_NPTH = 3
+
+# Zone settings
+ZONE_CONNECTION_FULL = 2
+ZONE_FILL_MODE_POLYGONS = 0
+
+# Copper layers
+UNDEFINED_LAYER = -1
+F_Cu = 0
+B_Cu = 31
+Cmts_User = 43
+
+# Graphic shapes
+SHAPE_T_POLY = 4
+
+
+def KiROUND(v):
+    """Round half away from zero, as KiCad does"""
+    return int(floor(v + 0.5)) if v >= 0 else -int(floor(-v + 0.5))
+
+
+def FromMM(mm):
+    return int(float(mm) * IU_PER_MM)
+
+
+def ToMM(iu):
+    return float(iu) / IU_PER_MM
+
+
+class wxPoint(object):
+    """Integer point. Float coordinates are truncated."""
+    __slots__ = ("x", "y")
+
+    def __init__(self, x=0, y=0):
+        self.x = int(x)
+        self.y = int(y)
+
+    def __getitem__(self, i):
+        return (self.x, self.y)[i]
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter((self.x, self.y))
+
+    def __add__(self, o):
+        return self.__class__(self.x + o[0], self.y + o[1])
+
+    def __sub__(self, o):
+        return self.__class__(self.x - o[0], self.y - o[1])
+
+    def __eq__(self, o):
+        return self.x == o[0] and self.y == o[1]
+
+    def __ne__(self, o):
+        return not self == o
+
+    # Like the SWIG proxies, points are not hashable
+    __hash__ = None
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.x, self.y)
+
+
+class VECTOR2I(wxPoint):
+    __slots__ = ()
+
+    def EuclideanNorm(self):
+        return hypot(self.x, self.y)
+
+
+class wxSize(wxPoint):
+    __slots__ = ()
+
+
+class EDA_ANGLE(object):
+    __slots__ = ("deg",)
+
+    def __init__(self, deg):
+        self.deg = deg
+
+    def AsTenthsOfADegree(self):
+        return self.deg * 10.0
+
+    def AsDegrees(self):
+        return self.deg
+
+
+def _Normalize(deg):
+    while deg < 0:
+        deg += 360.0
+    while deg >= 360.0:
+        deg -= 360.0
+    return deg
+
+
+def _Normalize180(deg):
+    while deg <= -180.0:
+        deg += 360.0
+    while deg > 180.0:
+        deg -= 360.0
+    return deg
+
+
+def _Angle(v):
+    return atan2(v[1], v[0]) * 180.0 / pi
+
+
+def _SegmentDistance(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    ll = dx * dx + dy * dy
+    if ll == 0:
+        return hypot(p[0] - a[0], p[1] - a[1])
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / float(ll)
+    t = max(0.0, min(1.0, t))
+    return hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+class BOX2I(object):
+    __slots__ = ("x0", "y0", "x1", "y1")
+
+    def __init__(self, x0, y0, x1, y1):
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+
+    def GetX(self):
+        return self.x0
+
+    def GetY(self):
+        return self.y0
+
+    def GetWidth(self):
+        return self.x1 - self.x0
+
+    def GetHeight(self):
+        return self.y1 - self.y0
+
+    def GetLeft(self):
+        return self.x0
+
+    def GetTop(self):
+        return self.y0
+
+    def GetRight(self):
+        return self.x1
+
+    def GetBottom(self):
+        return self.y1
+
+    def GetCenter(self):
+        return VECTOR2I((self.x0 + self.x1) // 2, (self.y0 + self.y1) // 2)
+
+    def Contains(self, p):
+        return self.x0 <= p[0] <= self.x1 and self.y0 <= p[1] <= self.y1
+
+
+class LSET(object):
+    def __init__(self, layers):
+        self.layers = sorted(layers)
+
+    def CuStack(self):
+        return [la for la in self.layers if F_Cu <= la <= B_Cu]
+
+    def Seq(self):
+        return list(self.layers)
+
+    def Contains(self, layer):
+        return layer in self.layers
+
+
+class BOARD_ITEM(object):
+    _uid = 0
+
+    def __init__(self, parent=None):
+        BOARD_ITEM._uid += 1
+        self.m_Uuid = BOARD_ITEM._uid
+        self.selected = False
+        self.layer = F_Cu
+        self.net = ""
+        self.netcode = 0
+
+    def GetClass(self):
+        return self.__class__.__name__
+
+    def IsSelected(self):
+        return self.selected
+
+    def SetSelected(self):
+        self.selected = True
+
+    def ClearSelected(self):
+        self.selected = False
+
+    def GetLayer(self):
+        return self.layer
+
+    def SetLayer(self, layer):
+        self.layer = layer
+
+    def IsOnLayer(self, layer):
+        return self.layer == layer
+
+    def GetNetname(self):
+        return self.net
+
+    def GetNetCode(self):
+        return self.netcode
+
+    def SetNetCode(self, code):
+        self.netcode = code
+
+    def GetLocalClearance(self, source=None):
+        return 0
+
+
+class PCB_TRACK(BOARD_ITEM):
+    def __init__(self, parent=None, start=(0, 0), end=(0, 0), width=0,
+                 layer=F_Cu, net="", netcode=0):
+        super(PCB_TRACK, self).__init__(parent)
+        self.start = VECTOR2I(*start)
+        self.end = VECTOR2I(*end)
+        self.width = width
+        self.layer = layer
+        self.net = net
+        self.netcode = netcode
+
+    def GetStart(self):
+        return VECTOR2I(self.start.x, self.start.y)
+
+    def GetEnd(self):
+        return VECTOR2I(self.end.x, self.end.y)
+
+    def GetWidth(self):
+        return self.width
+
+    def GetPosition(self):
+        return self.GetStart()
+
+    def GetLength(self):
+        return hypot(self.end.x - self.start.x, self.end.y - self.start.y)
+
+    def IsPointOnEnds(self, point, min_dist=0):
+        result = 0
+        if min_dist < 0:
+            min_dist = self.width // 2
+        if min_dist == 0:
+            if self.start == point:
+                result |= STARTPOINT
+            if self.end == point:
+                result |= ENDPOINT
+        else:
+            if min_dist >= KiROUND(hypot(self.start.x - point[0],
+                                         self.start.y - point[1])):
+                result |= STARTPOINT
+            if min_dist >= KiROUND(hypot(self.end.x - point[0],
+                                         self.end.y - point[1])):
+                result |= ENDPOINT
+        return result
+
+    def HitTest(self, point, accuracy=0):
+        return _SegmentDistance(point, self.start, self.end) <= \
+            accuracy + self.width / 2
+
+    def GetBoundingBox(self):
+        w = self.width // 2
+        return BOX2I(min(self.start.x, self.end.x) - w,
+                     min(self.start.y, self.end.y) - w,
+                     max(self.start.x, self.end.x) + w,
+                     max(self.start.y, self.end.y) + w)
+
+
+class PCB_ARC(PCB_TRACK):
+    def __init__(self, parent=None, start=(0, 0), mid=(0, 0), end=(0, 0),
+                 width=0, layer=F_Cu, net="", netcode=0):
+        super(PCB_ARC, self).__init__(parent, start, end, width, layer, net,
+                                      netcode)
+        self.mid = VECTOR2I(*mid)
+
+    def GetMid(self):
+        return VECTOR2I(self.mid.x, self.mid.y)
+
+    def GetCenter(self):
+        (ax, ay), (bx, by), (cx, cy) = self.start, self.mid, self.end
+        d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        ux = ((ax * ax + ay * ay) * (by - cy) + (bx * bx + by * by) * (cy - ay)
+              + (cx * cx + cy * cy) * (ay - by)) / d
+        uy = ((ax * ax + ay * ay) * (cx - bx) + (bx * bx + by * by) * (ax - cx)
+              + (cx * cx + cy * cy) * (bx - ax)) / d
+        return VECTOR2I(KiROUND(ux), KiROUND(uy))
+
+    def GetPosition(self):
+        return self.GetCenter()
+
+    def GetRadius(self):
+        c = self.GetCenter()
+        return KiROUND(hypot(self.start.x - c.x, self.start.y - c.y))
+
+    def GetAngle(self):
+        c = self.GetCenter()
+        a1 = _Normalize180(_Angle(self.mid - c) - _Angle(self.start - c))
+        a2 = _Normalize180(_Angle(self.end - c) - _Angle(self.mid - c))
+        return EDA_ANGLE(a1 + a2)
+
+    def GetArcAngleStart(self):
+        return EDA_ANGLE(_Normalize(_Angle(self.start - self.GetCenter())))
+
+    def GetArcAngleEnd(self):
+        return EDA_ANGLE(_Normalize(_Angle(self.end - self.GetCenter())))
+
+    def GetLength(self):
+        return self.GetRadius() * abs(self.GetAngle().AsDegrees()) * pi / 180
+
+    def HitTest(self, point, accuracy=0):
+        c = self.GetCenter()
+        max_dist = accuracy + self.width / 2
+        # Close to the circle and within the angular span
+        if abs(hypot(point[0] - c.x, point[1] - c.y) - self.GetRadius()) \
+                > max_dist:
+            return False
+        angle = self.GetAngle().AsDegrees()
+        rel = _Angle((point[0] - c.x, point[1] - c.y)) - \
+            _Angle(self.start - c)
+        rel = _Normalize(rel) if angle >= 0 else _Normalize(-rel)
+        return rel <= abs(angle) or \
+            _SegmentDistance(point, self.start, self.start) <= max_dist or \
+            _SegmentDistance(point, self.end, self.end) <= max_dist
+
+
+class PCB_VIA(PCB_TRACK):
+    def __init__(self, parent=None, pos=(0, 0), width=0, drill=0,
+                 net="", netcode=0):
+        if isinstance(parent, PCB_VIA):
+            # Cast-like copy constructor
+            via = parent
+            super(PCB_VIA, self).__init__(None, via.start, via.end, via.width,
+                                          via.layer, via.net, via.netcode)
+            self.drill = via.drill
+            self.selected = via.selected
+            return
+        super(PCB_VIA, self).__init__(parent, pos, pos, width, F_Cu, net,
+                                      netcode)
+        self.drill = drill
+
+    def GetDrillValue(self):
+        return self.drill
+
+    def IsOnLayer(self, layer):
+        return F_Cu <= layer <= B_Cu
+
+    def HitTest(self, point, accuracy=0):
+        return hypot(point[0] - self.start.x, point[1] - self.start.y) <= \
+            accuracy + self.width / 2
+
+
+class PAD(BOARD_ITEM):
+    def __init__(self, parent=None, pos=(0, 0), size=(0, 0),
+                 attribute=PAD_ATTRIB_PTH, layers=(F_Cu, B_Cu), net="",
+                 netcode=0):
+        super(PAD, self).__init__(parent)
+        self.pos = VECTOR2I(*pos)
+        self.size = wxSize(*size)
+        self.attribute = attribute
+        self.layers = LSET(layers)
+        self.net = net
+        self.netcode = netcode
+
+    def GetPosition(self):
+        return VECTOR2I(self.pos.x, self.pos.y)
+
+    def GetSize(self):
+        return wxSize(self.size.x, self.size.y)
+
+    def GetAttribute(self):
+        return self.attribute
+
+    def GetLayerSet(self):
+        return self.layers
+
+    def GetLayer(self):
+        cu = self.layers.CuStack()
+        return cu[0] if cu else -1
+
+
+class SHAPE_LINE_CHAIN(object):
+    def __init__(self):
+        self.points = []
+
+    def Append(self, x, y=None):
+        if y is None:
+            x, y = x
+        self.points.append((int(x), int(y)))
+
+    def PointCount(self):
+        return len(self.points)
+
+    def CPoint(self, i):
+        return VECTOR2I(*self.points[i])
+
+
+class SHAPE_POLY_SET(object):
+    def __init__(self):
+        self.outlines = []
+
+    def NewOutline(self):
+        self.outlines.append(SHAPE_LINE_CHAIN())
+        return len(self.outlines) - 1
+
+    def Append(self, x, y, outline=-1):
+        self.outlines[outline].Append(x, y)
+
+    def OutlineCount(self):
+        return len(self.outlines)
+
+    def Outline(self, i):
+        return self.outlines[i]
+
+    def TotalVertices(self):
+        return sum(o.PointCount() for o in self.outlines)
+
+    def RemoveAllContours(self):
+        self.outlines = []
+
+    def Contains(self, p, subpoly=-1, accuracy=0):
+        outlines = self.outlines if subpoly < 0 else [self.outlines[subpoly]]
+        for o in outlines:
+            if _PointInPolygon(p, o.points):
+                return True
+        return False
+
+    def BBox(self):
+        pts = [p for o in self.outlines for p in o.points]
+        if not pts:
+            return BOX2I(0, 0, 0, 0)
+        xs = [p[0] for p in pts]
+        ys = [p[1] for p in pts]
+        return BOX2I(min(xs), min(ys), max(xs), max(ys))
+
+
+def _PointInPolygon(p, pts):
+    x, y = p[0], p[1]
+    inside = False
+    n = len(pts)
+    for i in range(n):
+        x0, y0 = pts[i - 1]
+        x1, y1 = pts[i]
+        if (y0 > y) != (y1 > y):
+            xc = x0 + (y - y0) * (x1 - x0) / float(y1 - y0)
+            if x < xc:
+                inside = not inside
+    return inside
+
+
+class ZONE_SETTINGS(object):
+    SMOOTHING_NONE = 0
+
+
+class ZONE(BOARD_ITEM):
+    def __init__(self, parent=None):
+        super(ZONE, self).__init__(parent)
+        self.outline = SHAPE_POLY_SET()
+        self.layers = None
+        self.priority = 0
+        self.filled = False
+        self.fill_count = 0
+        self.props = {}
+        self.name = ""
+
+    def SetZoneName(self, name):
+        self.name = name
+
+    def GetZoneName(self):
+        return self.name
+
+    def SetLayer(self, layer):
+        self.layer = layer
+        self.layers = None
+
+    def SetLayerSet(self, lset):
+        self.layers = lset
+
+    def GetLayerSet(self):
+        return self.layers if self.layers is not None else LSET([self.layer])
+
+    def IsOnLayer(self, layer):
+        return self.GetLayerSet().Contains(layer)
+
+    def SetNetCode(self, code):
+        self.netcode = code
+
+    def SetLocalClearance(self, v):
+        self.props["clearance"] = v
+
+    def SetMinThickness(self, v):
+        self.props["min_thickness"] = v
+
+    def SetPadConnection(self, v):
+        self.props["pad_connection"] = v
+
+    def SetCornerSmoothingType(self, v):
+        self.props["smoothing"] = v
+
+    def SetFillMode(self, v):
+        self.props["fill_mode"] = v
+
+    def SetIsFilled(self, v):
+        self.filled = v
+
+    def IsFilled(self):
+        return self.filled
+
+    def SetAssignedPriority(self, p):
+        self.priority = p
+
+    def GetAssignedPriority(self):
+        return self.priority
+
+    def Outline(self):
+        return self.outline
+
+    def GetNumCorners(self):
+        return self.outline.TotalVertices()
+
+    def GetBoundingBox(self):
+        return self.outline.BBox()
+
+    def HitTest(self, point, accuracy=0):
+        # Like KiCad, only the outline corners and edges are hit
+        accuracy = max(accuracy, FromMM(0.1))
+        for o in self.outline.outlines:
+            pts = o.points
+            for i in range(len(pts)):
+                if hypot(point[0] - pts[i][0], point[1] - pts[i][1]) <= \
+                        accuracy * 2:
+                    return True
+            for i in range(len(pts)):
+                if _SegmentDistance(point, pts[i - 1], pts[i]) <= accuracy:
+                    return True
+        return False
+
+
+class ZONE_FILLER(object):
+    """Records which zones were filled instead of filling them"""
+    def __init__(self, board):
+        self.board = board
+
+    def Fill(self, zones, check=False):
+        zones = list(zones)
+        for z in zones:
+            z.fill_count += 1
+        self.board.filled_zones += len(zones)
+        return True
+
+
+class PCB_SHAPE(BOARD_ITEM):
+    def __init__(self, parent=None):
+        super(PCB_SHAPE, self).__init__(parent)
+        self.shape = None
+        self.filled = False
+        self.width = 0
+        self.poly = SHAPE_POLY_SET()
+
+    def SetShape(self, shape):
+        self.shape = shape
+
+    def SetFilled(self, filled):
+        self.filled = filled
+
+    def SetWidth(self, width):
+        self.width = width
+
+    def GetPolyShape(self):
+        return self.poly
+
+
+class PCB_GROUP(BOARD_ITEM):
+    def __init__(self, parent=None):
+        super(PCB_GROUP, self).__init__(parent)
+        self.name = ""
+        self.items = []
+
+    def SetName(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+    def AddItem(self, item):
+        self.items.append(item)
+        item.group = self
+
+    def RemoveItem(self, item):
+        self.items.remove(item)
+        item.group = None
+
+    def GetItems(self):
+        return list(self.items)
+
+
+class BOARD(object):
+    def __init__(self):
+        self.tracks = []
+        self.pads = []
+        self.zones = []
+        self.drawings = []
+        self.groups = []
+        self.filled_zones = 0
+        self.filename = ""
+        self.netcodes = {"": 0}
+
+    def NetCode(self, name):
+        """Stand-in only: netcode for the given net name"""
+        if name not in self.netcodes:
+            self.netcodes[name] = len(self.netcodes)
+        return self.netcodes[name]
+
+    def GetTracks(self):
+        return list(self.tracks)
+
+    def Tracks(self):
+        return list(self.tracks)
+
+    def GetPads(self):
+        return list(self.pads)
+
+    def GetAreaCount(self):
+        return len(self.zones)
+
+    def GetArea(self, i):
+        return self.zones[i]
+
+    def Zones(self):
+        return list(self.zones)
+
+    def GetDrawings(self):
+        return list(self.drawings)
+
+    def Groups(self):
+        return list(self.groups)
+
+    def Add(self, item):
+        if isinstance(item, ZONE):
+            if not item.net:
+                for name, code in self.netcodes.items():
+                    if code == item.netcode:
+                        item.net = name
+            self.zones.append(item)
+        elif isinstance(item, PAD):
+            self.pads.append(item)
+        elif isinstance(item, PCB_GROUP):
+            self.groups.append(item)
+        elif isinstance(item, PCB_SHAPE):
+            self.drawings.append(item)
+        else:
+            self.tracks.append(item)
+
+    def Remove(self, item):
+        if isinstance(item, ZONE):
+            self.zones.remove(item)
+        elif isinstance(item, PAD):
+            self.pads.remove(item)
+        elif isinstance(item, PCB_GROUP):
+            self.groups.remove(item)
+        elif isinstance(item, PCB_SHAPE):
+            self.drawings.remove(item)
+        else:
+            self.tracks.remove(item)
+        # Like KiCad, a removed item leaves its group
+        if getattr(item, "group", None) is not None:
+            item.group.RemoveItem(item)
+
+    def GetFileName(self):
+        return self.filename
+
+    def GetLayerID(self, name):
+        if name == "F.Cu":
+            return F_Cu
+        if name == "B.Cu":
+            return B_Cu
+        if name.startswith("In") and name.endswith(".Cu"):
+            try:
+                return int(name[2:-3])
+            except ValueError:
+                pass
+        return UNDEFINED_LAYER
+
+    def GetLayerName(self, layer):
+        if layer == F_Cu:
+            return "F.Cu"
+        if layer == B_Cu:
+            return "B.Cu"
+        if layer == Cmts_User:
+            return "Cmts.User"
+        return "In{}.Cu".format(layer)
+
+
+_board = None
+
+
+def GetBoard():
+    return _board
+
+
+def SetBoard(board):
+    """Stand-in only: set the board returned by GetBoard"""
+    global _board
+    _board = board
+
+
+def Refresh():
+    pass
+
+
+def Install(force=False):
+    """Register this module as pcbnew when KiCad is not available
+
+    With force, it replaces pcbnew even when KiCad is installed.
+    """
+    if not force:
+        try:
+            import pcbnew  # noqa: F401
+            return False
+        except ImportError:
+            pass
+    sys.modules["pcbnew"] = sys.modules[__name__]
+    return True
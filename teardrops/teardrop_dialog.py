@@ -10,10 +10,24 @@
 import wx
 import pcbnew
 import os
+import threading
 import time
 
 from .teardrop_gui import teardrop_gui
-from .td import SetTeardrops, RmTeardrops, __version__
+from .td import RmTeardrops, PreviewTeardrops, ClearPreview
+from .td import PlanTeardrops, ApplyTeardrops
+from .td import __version__
+
+# Label of the progress stages, and what is counted in each of them
+STAGES = {"gather": ("Reading the board", "items"),
+          "match": ("Matching tracks", "vias/pads"),
+          "fingerprint": ("Checking fingerprints", "teardrops"),
+          "geometry": ("Computing outlines", "teardrops")}
+
+
+class Cancelled(Exception):
+    """Raised in the worker thread to stop the computation"""
+
 
 class TeardropDialog(teardrop_gui):
     """Class that gathers all the Gui control"""
@@ -25,46 +39,199 @@ class TeardropDialog(teardrop_gui):
         self.SetTitle("Teardrops (v{0})".format(__version__))
         self.rbx_action.Bind(wx.EVT_RADIOBOX, self.onAction)
         self.Bind(wx.EVT_CLOSE, self.onCloseWindow)
-        self.but_cancel.Bind(wx.EVT_BUTTON, self.onCloseWindow)
+        self.but_cancel.Bind(wx.EVT_BUTTON, self.onCancel)
         self.but_ok.Bind(wx.EVT_BUTTON, self.onProcessAction)
+        self.but_preview.Bind(wx.EVT_BUTTON, self.onPreview)
         self.m_bitmap_help.SetBitmap(wx.Bitmap( os.path.join(os.path.dirname(os.path.realpath(__file__)), "rcs", "teardrops-help.png") ) )
         self.SetMinSize(self.GetSize())
+        self.worker = None
+        self.cancel = threading.Event()
+        self.closing = False
 
     def onAction(self, e):
         """Enables or disables the parameters/options elements"""
         els = [self.st_hpercent, self.sp_hpercent, self.st_vpercent,
                self.sp_vpercent, self.st_nbseg, self.sp_nbseg,
+               self.st_tolerance, self.sp_tolerance,
                self.cb_include_smd_pads, self.cb_discard_in_same_zone,
-               self.cb_follow_tracks, self.cb_no_bulge]
+               self.cb_follow_tracks, self.cb_no_bulge, self.cb_update,
+               self.but_preview]
         for i, el in enumerate(els):
             if self.rbx_action.GetSelection() == 0:
                 el.Enable()
             else:
                 el.Disable()
 
+    def settings(self):
+        """Teardrop settings of the dialog, as SetTeardrops arguments"""
+        return dict(hpercent=self.sp_hpercent.GetValue(),
+                    vpercent=self.sp_vpercent.GetValue(),
+                    segs=self.sp_nbseg.GetValue(),
+                    use_smd=self.cb_include_smd_pads.IsChecked(),
+                    discard_in_same_zone=self.cb_discard_in_same_zone.IsChecked(),
+                    follow_tracks=self.cb_follow_tracks.IsChecked(),
+                    noBulge=self.cb_no_bulge.IsChecked(),
+                    update=self.cb_update.IsChecked(),
+                    tolerance=self.sp_tolerance.GetValue()*1000)
+
+    def onPreview(self, event):
+        """Draws the teardrops the settings would add, board left as is"""
+        start = time.time()
+        stats = PreviewTeardrops(pcb=self.board, draw=True, **self.settings())
+        message = "{} Teardrops would be inserted, took {:.3f} seconds".format(int(stats), time.time()-start)
+        pcbnew.Refresh()
+        if self.cb_show_stats.IsChecked():
+            ShowStats(self, message, stats)
+        else:
+            wx.MessageBox(message)
+
     def onProcessAction(self, event):
         """Executes the requested action"""
+        ClearPreview(self.board)
         if self.rbx_action.GetSelection() == 0:
-            start = time.time()
-            count = SetTeardrops(self.sp_hpercent.GetValue(),
-                                 self.sp_vpercent.GetValue(),
-                                 self.sp_nbseg.GetValue(),
-                                 self.board,
-                                 self.cb_include_smd_pads.IsChecked(),
-                                 self.cb_discard_in_same_zone.IsChecked(),
-                                 self.cb_follow_tracks.IsChecked(),
-                                 self.cb_no_bulge.IsChecked())
-            wx.MessageBox("{} Teardrops inserted, took {:.3f} seconds".format(count, time.time()-start))
+            self.startPlan()
+            return
+        count = RmTeardrops(pcb=self.board,
+                            incremental_fill=self.cb_incremental_fill.IsChecked(),
+                            stats=self.cb_show_stats.IsChecked())
+        self.finish("{0} Teardrops removed".format(int(count)), count)
+
+    def startPlan(self):
+        """Computes the teardrops in a worker thread, the dialog stays live.
+        The board is only read there, zones are added by onPlanned"""
+        self.cancel.clear()
+        self.start = time.time()
+        self.stage = None
+        self.setRunning(True)
+        self.worker = threading.Thread(target=self.plan,
+                                       args=(self.cb_show_stats.IsChecked(),
+                                             self.settings()))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def plan(self, stats, settings):
+        """Worker thread body, reports back through wx.CallAfter"""
+        try:
+            plan = PlanTeardrops(pcb=self.board, stats=stats,
+                                 progress=self.progress, **settings)
+        except Cancelled:
+            wx.CallAfter(self.onCancelled)
+        except Exception as e:
+            wx.CallAfter(self.onFailed, e)
         else:
-            count = RmTeardrops(pcb=self.board)
-            wx.MessageBox("{0} Teardrops removed".format(count))
+            wx.CallAfter(self.onPlanned, plan)
+
+    def progress(self, stage, done, total):
+        """Progress callback of PlanTeardrops, in the worker thread"""
+        if self.cancel.is_set():
+            raise Cancelled()
+        wx.CallAfter(self.onProgress, stage, done, total)
+
+    def onProgress(self, stage, done, total):
+        """Shows the progress of the current stage and its remaining time"""
+        if self.worker is None:
+            return
+        if stage != self.stage:
+            self.stage, self.stage_start = stage, time.time()
+        self.g_progress.SetRange(max(total, 1))
+        self.g_progress.SetValue(min(done, total))
+        label, unit = STAGES.get(stage, (stage, "items"))
+        text = "{}: {}/{} {}".format(label, done, total, unit)
+        elapsed = time.time() - self.stage_start
+        if 0 < done < total and elapsed > 1:
+            text += ", about {:.0f} s left".format(elapsed*(total-done)/done)
+        self.st_progress.SetLabel(text)
+
+    def onPlanned(self, plan):
+        """Adds and fills the computed teardrops, in the main thread"""
+        if self.cancel.is_set():
+            self.onCancelled()
+            return
+        self.g_progress.Pulse()
+        self.st_progress.SetLabel("Adding {} teardrops and filling the zones"
+                                  .format(len(plan.teardrops)))
+        self.Update()
+        try:
+            count = ApplyTeardrops(plan, self.cb_incremental_fill.IsChecked())
+        except Exception as e:
+            self.st_progress.SetLabel("")
+            wx.MessageBox("Teardrops failed: {}".format(e))
+            return
+        finally:
+            # Never leave the dialog locked, even if the board is half done
+            self.worker = None
+            self.setRunning(False)
+        message = "{} Teardrops inserted, took {:.3f} seconds".format(int(count), time.time()-self.start)
+        self.finish(message, count)
+
+    def onCancelled(self):
+        """The worker stopped before touching the board"""
+        self.worker = None
+        self.setRunning(False)
+        self.st_progress.SetLabel("Cancelled, the board was not modified")
+        if self.closing:
+            self.onCloseWindow(None)
+
+    def onFailed(self, error):
+        self.worker = None
+        self.setRunning(False)
+        self.st_progress.SetLabel("")
+        wx.MessageBox("Teardrops failed: {}".format(error))
+        if self.closing:
+            self.onCloseWindow(None)
+
+    def setRunning(self, running):
+        """Locks the settings while the worker runs, Cancel stays enabled"""
+        for el in self.GetChildren():
+            if el not in (self.but_cancel, self.g_progress, self.st_progress):
+                el.Enable(not running)
+        if not running:
+            self.g_progress.SetValue(0)
+            self.onAction(None)
+
+    def finish(self, message, stats):
+        if self.cb_show_stats.IsChecked():
+            ShowStats(self, message, stats)
+        else:
+            wx.MessageBox(message)
         pcbnew.Refresh() #Show up newly added vias
         self.EndModal(wx.ID_OK)
 
+    def onCancel(self, event):
+        """Stops the running computation, or closes the dialog"""
+        if self.worker is None:
+            self.onCloseWindow(event)
+        else:
+            self.cancel.set()
+            self.st_progress.SetLabel("Cancelling...")
+
     def onCloseWindow(self, event):
+        if self.worker is not None:
+            # Wait for the worker to stop, onCancelled closes then
+            self.closing = True
+            self.onCancel(event)
+            return
+        if ClearPreview(self.board):
+            pcbnew.Refresh()
         self.EndModal(wx.ID_OK)
 
 
+def ShowStats(parent, message, stats):
+    """Show the message and the stats summary table"""
+    dlg = wx.Dialog(parent, title="Teardrops statistics",
+                    style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+    sizer = wx.BoxSizer(wx.VERTICAL)
+    sizer.Add(wx.StaticText(dlg, label=message), 0, wx.ALL, 5)
+    table = wx.TextCtrl(dlg, value=stats.Summary(), size=wx.Size(350, 330),
+                        style=wx.TE_MULTILINE|wx.TE_READONLY|wx.TE_DONTWRAP)
+    table.SetFont(wx.Font(wx.FontInfo().Family(wx.FONTFAMILY_TELETYPE)))
+    sizer.Add(table, 1, wx.ALL|wx.EXPAND, 5)
+    sizer.Add(dlg.CreateStdDialogButtonSizer(wx.OK), 0, wx.ALL|wx.EXPAND, 5)
+    dlg.SetSizerAndFit(sizer)
+    dlg.ShowModal()
+    dlg.Destroy()
+
+
 def InitTeardropDialog(board):
     """Launch the dialog"""
     tg = TeardropDialog(board)
@@ -17,7 +17,7 @@ import wx.xrc
 class teardrop_gui ( wx.Dialog ):
 
 	def __init__( self, parent ):
-		wx.Dialog.__init__ ( self, parent, id = wx.ID_ANY, title = u"Teardrops", pos = wx.DefaultPosition, size = wx.Size( 450,368 ), style = wx.CAPTION|wx.CLOSE_BOX|wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER )
+		wx.Dialog.__init__ ( self, parent, id = wx.ID_ANY, title = u"Teardrops", pos = wx.DefaultPosition, size = wx.Size( 450,513 ), style = wx.CAPTION|wx.CLOSE_BOX|wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER )
 
 		#self.SetSizeHints( wx.DefaultSize, wx.DefaultSize )
 		import sys
@@ -61,6 +61,14 @@ class teardrop_gui ( wx.Dialog ):
 		self.sp_nbseg = wx.SpinCtrl( self, wx.ID_ANY, wx.EmptyString, wx.DefaultPosition, wx.Size( 100,25 ), wx.SP_ARROW_KEYS, 2, 100, 10 )
 		gs_params.Add( self.sp_nbseg, 0, wx.ALIGN_CENTER_VERTICAL|wx.ALIGN_RIGHT|wx.FIXED_MINSIZE|wx.SHAPED, 5 )
 
+		self.st_tolerance = wx.StaticText( self, wx.ID_ANY, u"Tolerance (um, 0 = off)", wx.DefaultPosition, wx.DefaultSize, 0 )
+		self.st_tolerance.Wrap( -1 )
+
+		gs_params.Add( self.st_tolerance, 0, wx.ALIGN_CENTER_VERTICAL|wx.ALIGN_RIGHT|wx.FIXED_MINSIZE, 5 )
+
+		self.sp_tolerance = wx.SpinCtrl( self, wx.ID_ANY, wx.EmptyString, wx.DefaultPosition, wx.Size( 100,25 ), wx.SP_ARROW_KEYS, 0, 100, 0 )
+		gs_params.Add( self.sp_tolerance, 0, wx.ALIGN_CENTER_VERTICAL|wx.ALIGN_RIGHT|wx.FIXED_MINSIZE|wx.SHAPED, 5 )
+
 
 		bhs_params.Add( gs_params, 1, wx.ALIGN_CENTER_VERTICAL|wx.EXPAND|wx.SHAPED, 5 )
 
@@ -90,6 +98,15 @@ class teardrop_gui ( wx.Dialog ):
 		self.cb_no_bulge.SetValue(True)
 		bvs_options.Add( self.cb_no_bulge, 0, wx.ALIGN_LEFT|wx.ALL|wx.EXPAND, 5 )
 
+		self.cb_update = wx.CheckBox( self, wx.ID_ANY, u"Only update the teardrops whose via, track or settings changed", wx.DefaultPosition, wx.DefaultSize, 0 )
+		bvs_options.Add( self.cb_update, 0, wx.ALIGN_LEFT|wx.ALL|wx.EXPAND, 5 )
+
+		self.cb_incremental_fill = wx.CheckBox( self, wx.ID_ANY, u"Only refill zones around modified teardrops", wx.DefaultPosition, wx.DefaultSize, 0 )
+		bvs_options.Add( self.cb_incremental_fill, 0, wx.ALIGN_LEFT|wx.ALL|wx.EXPAND, 5 )
+
+		self.cb_show_stats = wx.CheckBox( self, wx.ID_ANY, u"Show timings and counters after processing", wx.DefaultPosition, wx.DefaultSize, 0 )
+		bvs_options.Add( self.cb_show_stats, 0, wx.ALIGN_LEFT|wx.ALL|wx.EXPAND, 5 )
+
 		bvs_options.Add( ( 0, 0), 1, wx.EXPAND, 5 )
 
 
@@ -98,8 +115,20 @@ class teardrop_gui ( wx.Dialog ):
 		self.m_staticline1 = wx.StaticLine( self, wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, wx.LI_HORIZONTAL )
 		bvs_main.Add( self.m_staticline1, 0, wx.EXPAND |wx.ALL, 5 )
 
+		self.g_progress = wx.Gauge( self, wx.ID_ANY, 100, wx.DefaultPosition, wx.DefaultSize, wx.GA_HORIZONTAL )
+		self.g_progress.SetValue( 0 )
+		bvs_main.Add( self.g_progress, 0, wx.ALL|wx.EXPAND, 5 )
+
+		self.st_progress = wx.StaticText( self, wx.ID_ANY, wx.EmptyString, wx.DefaultPosition, wx.DefaultSize, 0 )
+		self.st_progress.Wrap( -1 )
+
+		bvs_main.Add( self.st_progress, 0, wx.LEFT|wx.RIGHT|wx.EXPAND, 5 )
+
 		bhs_modal = wx.BoxSizer( wx.HORIZONTAL )
 
+		self.but_preview = wx.Button( self, wx.ID_ANY, u"Preview", wx.DefaultPosition, wx.DefaultSize, 0 )
+		bhs_modal.Add( self.but_preview, 0, wx.ALL, 5 )
+
 		self.but_cancel = wx.Button( self, wx.ID_ANY, u"Cancel", wx.DefaultPosition, wx.DefaultSize, 0 )
 		bhs_modal.Add( self.but_cancel, 0, wx.ALL, 5 )
 